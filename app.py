@@ -2,14 +2,17 @@
 
 import os
 import functools
-from datetime import datetime
+from datetime import date, datetime
 import requests as http_requests
 from flask import Flask, request, jsonify, render_template, redirect, url_for, send_from_directory, session
-from sqlalchemy import create_engine, extract
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 import config
-from models import Base, Lead, User, BV, Transaction, Holding, AnnualReport, VPBFiling, init_db
+from models import Base, Lead, User, BV, AnnualReport, VPBFiling, ImportJob, init_db
+from services.instruments import load_instruments
+from services.ai_classifier import start_model_trainer
+from services.jobs import start_worker_pool
 
 # Ensure data directory exists
 os.makedirs(os.path.join(config.BASE_DIR, "data"), exist_ok=True)
@@ -24,6 +27,15 @@ app.secret_key = config.SECRET_KEY
 
 # Database setup
 engine, Session = init_db(config.DATABASE_URL)
+start_worker_pool(Session)
+start_model_trainer(Session)
+
+# ISIN → ticker index used by the broker parsers
+_db = Session()
+try:
+    load_instruments(_db)
+finally:
+    _db.close()
 
 
 def get_db():
@@ -252,6 +264,18 @@ def admin_leads():
         db.close()
 
 
+@app.route("/api/admin/stats")
+@login_required
+def admin_stats():
+    """Process-local performance counters."""
+    from services.ai_classifier import classification_stats
+    from services.locks import lock_stats
+    return jsonify({
+        "classifier": classification_stats(),
+        "locks": lock_stats(),
+    })
+
+
 # ─── Onboarding ──────────────────────────────────────────────────────────
 
 @app.route("/onboarding")
@@ -324,29 +348,23 @@ def dashboard():
         tax_savings = None
 
         if bv:
-            holdings = db.query(Holding).filter_by(bv_id=bv.id).all()
+            from services.read_models import holding_rows
+            holdings = holding_rows(db, bv.id)
             total_cost = sum(h.total_cost for h in holdings)
-            tx_count = db.query(Transaction).filter_by(bv_id=bv.id).count()
 
-            all_txs = db.query(Transaction).filter_by(bv_id=bv.id).all()
-            for tx in all_txs:
-                if tx.type == "deposit":
-                    total_deposits += abs(tx.amount)
-                elif tx.type == "dividend":
-                    total_dividends += abs(tx.amount)
-                elif tx.type == "sell":
-                    total_realized += tx.amount
+            from services.ledger_cache import get_ledger
+            ledger = get_ledger(db, bv.id)
+            tx_count = ledger.rows
+            total_deposits = ledger.total("deposit")
+            total_dividends = ledger.total("dividend")
+            total_realized = ledger.total("sell", absolute=False)
 
             current_year = datetime.now().year
-            year_txs = [
-                tx for tx in all_txs
-                if tx.date.year == current_year
-            ]
-            for tx in year_txs:
-                if tx.type in ("sell", "dividend", "interest"):
-                    ytd_pl += tx.amount
-                elif tx.type == "cost":
-                    ytd_pl -= abs(tx.amount)
+            year_start, year_end = date(current_year, 1, 1), date(current_year, 12, 31)
+            ytd_pl = sum(
+                ledger.total(tx_type, year_start, year_end, absolute=False)
+                for tx_type in ("sell", "dividend", "interest")
+            ) - ledger.total("cost", year_start, year_end)
 
             # Check report/filing status for most recent year
             report_2025 = db.query(AnnualReport).filter_by(bv_id=bv.id, year=2025).first()
@@ -383,6 +401,7 @@ def dashboard():
             filing_2025=filing_2025,
             tax_savings=tax_savings,
             is_demo=is_demo,
+            import_job=request.args.get("import_job", type=int),
         )
     finally:
         db.close()
@@ -406,39 +425,30 @@ def import_csv():
         if not bv:
             return jsonify({"error": "Geen BV gevonden"}), 404
 
-        content = file.read().decode("utf-8-sig")
+        # Parse → classify → persist → process runs in the background worker pool
+        from services.jobs import enqueue_import
+        job = enqueue_import(db, bv.id, file.stream, broker_type)
+        if not job:
+            return jsonify({"error": "Dit bestand is al geïmporteerd"}), 409
 
-        from services.broker_import import parse_degiro_csv, parse_ib_csv
-        if broker_type == "ib":
-            parsed = parse_ib_csv(content)
-        else:
-            parsed = parse_degiro_csv(content)
-
-        from services.ai_classifier import classify_transactions
-        parsed = classify_transactions(parsed)
-
-        for tx_data in parsed:
-            tx = Transaction(
-                bv_id=bv.id,
-                date=tx_data["date"],
-                type=tx_data.get("type", "other"),
-                ticker=tx_data.get("ticker"),
-                description=tx_data["description"],
-                quantity=tx_data.get("quantity"),
-                price=tx_data.get("price"),
-                amount=tx_data["amount"],
-                currency=tx_data.get("currency", "EUR"),
-                broker_ref=tx_data.get("broker_ref", ""),
-                category=tx_data.get("type"),
-            )
-            db.add(tx)
+        return redirect(url_for("dashboard", import_job=job.id))
+    finally:
+        db.close()
 
-        db.commit()
 
-        from services.transaction_engine import process_transactions
-        process_transactions(db, bv.id)
+@app.route("/api/import/<int:job_id>")
+@login_required
+def import_status(job_id):
+    db = get_db()
+    try:
+        user = get_current_user(db)
+        bv = db.query(BV).filter_by(user_id=user.id).first()
+        job = db.get(ImportJob, job_id)
+        if not bv or not job or job.bv_id != bv.id:
+            return jsonify({"error": "Import niet gevonden"}), 404
 
-        return redirect(url_for("dashboard"))
+        from services.jobs import job_status
+        return jsonify(job_status(job))
     finally:
         db.close()
 
@@ -459,18 +469,11 @@ def transactions_view():
         filter_type = request.args.get("type", "")
         filter_year = request.args.get("year", "")
 
-        if bv:
-            query = db.query(Transaction).filter_by(bv_id=bv.id)
-            if filter_type:
-                query = query.filter_by(type=filter_type)
-            if filter_year:
-                query = query.filter(extract("year", Transaction.date) == int(filter_year))
-            txs = query.order_by(Transaction.date.desc()).all()
-
         years = []
         if bv:
-            all_txs = db.query(Transaction.date).filter_by(bv_id=bv.id).all()
-            years = sorted(set(tx.date.year for tx in all_txs), reverse=True)
+            from services.read_models import transaction_rows, transaction_years
+            txs = transaction_rows(db, bv.id, filter_type, int(filter_year) if filter_year else None)
+            years = transaction_years(db, bv.id)
 
         return render_template(
             "transactions.html",
@@ -528,7 +531,12 @@ def generate_report():
             return jsonify({"error": "Geen BV gevonden"}), 404
 
         from services.annual_report import generate_annual_report
-        generate_annual_report(db, bv.id, year)
+        from services.locks import BVLocked, bv_lock
+        try:
+            with bv_lock(db, bv.id, timeout=0):
+                generate_annual_report(db, bv.id, year)
+        except BVLocked:
+            return jsonify({"error": "Er loopt al een verwerking voor deze BV, probeer het later opnieuw"}), 409
 
         return redirect(url_for("annual_report_view", year=year))
     finally:
@@ -587,13 +595,47 @@ def calculate_vpb_route():
             return jsonify({"error": "Geen BV gevonden"}), 404
 
         from services.annual_report import generate_annual_report
-        generate_annual_report(db, bv.id, year)
+        from services.locks import BVLocked, bv_lock
+        try:
+            with bv_lock(db, bv.id, timeout=0):
+                generate_annual_report(db, bv.id, year)
+        except BVLocked:
+            return jsonify({"error": "Er loopt al een verwerking voor deze BV, probeer het later opnieuw"}), 409
 
         return redirect(url_for("vpb_view", year=year))
     finally:
         db.close()
 
 
+@app.route("/api/simulate", methods=["POST"])
+@login_required
+def simulate_route():
+    """What-if: W&V, balans and VPB after hypothetical trades. Nothing is saved."""
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "Ongeldige aanvraag"}), 400
+    try:
+        year = int(payload.get("year") or datetime.now().year)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Ongeldig jaar"}), 400
+    trades = payload.get("trades") or []
+
+    db = get_db()
+    try:
+        user = get_current_user(db)
+        bv = db.query(BV).filter_by(user_id=user.id).first()
+        if not bv:
+            return jsonify({"error": "Geen BV gevonden"}), 404
+
+        from services.simulation import simulate
+        try:
+            return jsonify(simulate(db, bv.id, year, trades))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    finally:
+        db.close()
+
+
 # ─── Main ─────────────────────────────────────────────────────────────────
 
 if __name__ == "__main__":
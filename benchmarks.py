@@ -0,0 +1,334 @@
+"""Performance benchmarks for BoxShift hot paths.
+
+Usage: python benchmarks.py <benchmark> [--rows N] [--db URL]
+    insert  ORM vs bulk insert of imported transactions
+    rules   rule-based classifier at e.g. --rows 1000000
+    read-models  ORM objects vs read-only rows for reporting, e.g. --rows 100000
+    report  annual report totals, Python pass vs rollup-fed ledger cache, e.g. --rows 1000000
+Runs against a throwaway in-memory SQLite database unless --db is given.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+# Ensure we can import from project root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import User, BV, Transaction, init_db
+
+
+def _setup(db_url: str):
+    engine, Session = init_db(db_url)
+    db = Session()
+    user = User(email=f"bench-{time.time_ns()}@boxshift.nl", name="Benchmark")
+    db.add(user)
+    db.flush()
+    bv = BV(user_id=user.id, name="Benchmark B.V.")
+    db.add(bv)
+    db.commit()
+    return db, bv.id
+
+
+def _fake_parsed(n: int) -> list[dict]:
+    """Generate n parsed transaction dicts as broker_import would yield them."""
+    tickers = ["VWRL.AS", "IWDA.AS", "VWCE.DE", "EMIM.AS", "ASML.AS", "HEIA.AS"]
+    start = date(2020, 1, 1)
+    rows = []
+    for i in range(n):
+        qty = float(random.randint(1, 50))
+        price = round(random.uniform(20, 800), 2)
+        rows.append({
+            "date": start + timedelta(days=i % 2000),
+            "type": "buy",
+            "ticker": random.choice(tickers),
+            "description": "Benchmark instrument",
+            "quantity": qty,
+            "price": price,
+            "amount": -round(qty * price, 2),
+            "currency": "EUR",
+            "broker_ref": f"bench-{i}",
+        })
+    return rows
+
+
+def _report(label: str, rows: int, seconds: float):
+    print(f"  {label:<24} {rows:>9,} rows  {seconds:8.3f}s  {rows / seconds:>12,.0f} rows/sec")
+
+
+def bench_insert(args):
+    """ORM db.add() per row vs bulk executemany insert."""
+    from services.importer import bulk_insert_transactions, _transaction_row
+
+    parsed = _fake_parsed(args.rows)
+    print(f"Insert {args.rows:,} transactions ({args.db})")
+
+    db, bv_id = _setup(args.db)
+    t0 = time.perf_counter()
+    for tx_data in parsed:
+        db.add(Transaction(**_transaction_row(bv_id, tx_data)))
+    db.commit()
+    _report("ORM db.add()", args.rows, time.perf_counter() - t0)
+    db.close()
+
+    db, bv_id = _setup(args.db)
+    t0 = time.perf_counter()
+    ids = []
+    for i in range(0, len(parsed), args.batch):
+        ids.extend(bulk_insert_transactions(db, bv_id, parsed[i:i + args.batch]))
+    db.commit()
+    _report("bulk insert()", len(ids), time.perf_counter() - t0)
+    db.close()
+
+
+def _legacy_rule_classify(transactions: list[dict]) -> list[dict]:
+    """The pre-compiled-matcher fallback classifier, kept for comparison."""
+    for tx in transactions:
+        desc = tx.get("description", "").lower()
+        amount = tx.get("amount", 0)
+        qty = tx.get("quantity")
+        price = tx.get("price")
+
+        if qty and price:
+            tx["type"] = "buy" if amount < 0 else "sell"
+        elif "dividend" in desc:
+            tx["type"] = "dividend"
+        elif "rente" in desc or "interest" in desc:
+            tx["type"] = "interest"
+        elif "kosten" in desc or "fee" in desc or "commission" in desc:
+            tx["type"] = "cost"
+        elif "storting" in desc or "deposit" in desc:
+            tx["type"] = "deposit"
+        elif "opname" in desc or "withdrawal" in desc:
+            tx["type"] = "withdrawal"
+        elif amount > 0:
+            tx["type"] = "deposit"
+        else:
+            tx["type"] = "cost"
+    return transactions
+
+
+def bench_rules(args):
+    """Keyword if-chain vs the per-batch memoized rule matcher."""
+    from services.ai_classifier import _rule_based_classify, add_rules
+
+    descriptions = [
+        ("Dividend Vanguard FTSE All-World", 42.1, None, None),
+        ("DEGIRO transactiekosten en/of kosten van derden", -2.0, None, None),
+        ("Rente-inkomsten DEGIRO kasrekening", 1.3, None, None),
+        ("iDEAL storting", 1000.0, None, None),
+        ("Terugstorting opname", -500.0, None, None),
+        ("VANGUARD FTSE ALL-WORLD UCITS ETF", -950.0, 10.0, 95.0),
+        ("Valuta Creditering", 12.0, None, None),
+        ("Flatex Interest Income", 0.4, None, None),
+    ]
+    add_rules("bench", [("cost", [f"benchmark-keyword-{i}"]) for i in range(200)])
+
+    # ~2,000 instruments (~16,000 distinct descriptions), then every row distinct
+    for label, instruments in (("repeating", 1999), ("all distinct", args.rows)):
+        rows = []
+        for i in range(args.rows):
+            d, a, q, p = descriptions[i % len(descriptions)]
+            rows.append({"description": f"{d} {i % instruments}", "amount": a, "quantity": q, "price": p})
+        distinct = len({r["description"] for r in rows})
+        print(f"Rule-based classification of {args.rows:,} rows, {label} ({distinct:,} distinct descriptions)")
+
+        legacy = [dict(r) for r in rows]
+        t0 = time.perf_counter()
+        _legacy_rule_classify(legacy)
+        _report("if-chain per row", args.rows, time.perf_counter() - t0)
+
+        matched = [dict(r) for r in rows]
+        t0 = time.perf_counter()
+        _rule_based_classify(matched)
+        _report("memoized rules", args.rows, time.perf_counter() - t0)
+
+        mismatches = sum(a["type"] != b["type"] for a, b in zip(legacy, matched))
+        print(f"  mismatches vs if-chain: {mismatches}")
+
+        extended = [dict(r) for r in rows]
+        t0 = time.perf_counter()
+        _rule_based_classify(extended, "bench")
+        _report("memoized, +200 rules", args.rows, time.perf_counter() - t0)
+
+
+def _measure(fn):
+    """(result, seconds, peak MB) of fn(); memory is traced in a second run."""
+    import gc
+    import tracemalloc
+
+    gc.collect()
+    t0 = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - t0
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_read_models(args):
+    """Hydrated ORM Transactions vs read_models rows on one large BV."""
+    from sqlalchemy import update
+    from services.importer import bulk_insert_transactions
+    from services.read_models import trade_rows, transaction_rows
+
+    db, bv_id = _setup(args.db)
+    parsed = _fake_parsed(args.rows)
+    for i in range(0, len(parsed), args.batch):
+        bulk_insert_transactions(db, bv_id, parsed[i:i + args.batch])
+    db.execute(update(Transaction).where(Transaction.bv_id == bv_id).values(processed=True))
+    db.commit()
+    print(f"Read {args.rows:,} transactions of one BV ({args.db})")
+
+    cases = [
+        ("transactions view", lambda: (
+            db.query(Transaction).filter_by(bv_id=bv_id).order_by(Transaction.date.desc()).all()
+        ), lambda: transaction_rows(db, bv_id)),
+        ("year-end replay input", lambda: (
+            db.query(Transaction)
+            .filter(Transaction.bv_id == bv_id, Transaction.processed == True,  # noqa: E712
+                    Transaction.type.in_(("buy", "sell")), Transaction.date <= date(2030, 12, 31))
+            .order_by(Transaction.date, Transaction.id).all()
+        ), lambda: trade_rows(db, bv_id, date(2030, 12, 31))),
+    ]
+    for label, orm_path, rows_path in cases:
+        print(f"  {label}")
+        for name, fn in (("ORM objects", orm_path), ("read_models rows", rows_path)):
+            rows, seconds, peak = _measure(fn)
+            _report(name, len(rows), seconds)
+            print(f"  {'':<24} peak memory {peak:8.1f} MB")
+            del rows
+            db.expunge_all()
+    db.close()
+
+
+def _fake_ledger(n: int) -> list[dict]:
+    """n parsed transactions of mixed types over 2020-2025."""
+    tickers = ["VWRL.AS", "IWDA.AS", "VWCE.DE", "EMIM.AS", "ASML.AS", "HEIA.AS"]
+    types = ["buy"] * 4 + ["sell"] * 2 + ["dividend", "cost", "interest", "deposit", "withdrawal"]
+    start = date(2020, 1, 1)
+    rows = []
+    for i in range(n):
+        tx_type = random.choice(types)
+        trade = tx_type in ("buy", "sell")
+        qty = float(random.randint(1, 50)) if trade else None
+        price = round(random.uniform(20, 800), 2) if trade else None
+        amount = round(qty * price, 2) if trade else round(random.uniform(1, 500), 2)
+        rows.append({
+            "date": start + timedelta(days=i % 2190),
+            "type": tx_type,
+            "ticker": random.choice(tickers) if trade else None,
+            "description": f"Benchmark {tx_type}",
+            "quantity": qty,
+            "price": price,
+            "amount": -amount if tx_type in ("buy", "cost", "withdrawal") else amount,
+            "currency": "EUR",
+            "broker_ref": f"bench-{i}",
+        })
+    return rows
+
+
+def _legacy_year_totals(db, bv_id: int, year: int) -> tuple[dict, float, float]:
+    """Report totals as summed in Python over the whole ledger, kept for comparison."""
+    from models import RealizedGain
+
+    start, end = date(year, 1, 1), date(year, 12, 31)
+    stored_gains = dict(
+        db.query(RealizedGain.sell_tx_id, RealizedGain.gain)
+        .filter(RealizedGain.bv_id == bv_id, RealizedGain.date >= start, RealizedGain.date <= end)
+    )
+    in_year, to_date = {}, {}
+    realized_gains = 0.0
+    rows = db.query(Transaction.id, Transaction.date, Transaction.type, Transaction.amount).filter(
+        Transaction.bv_id == bv_id, Transaction.date <= end
+    )
+    for tx_id, tx_date, tx_type, amount in rows:
+        to_date[tx_type] = to_date.get(tx_type, 0.0) + abs(amount)
+        if tx_date >= start:
+            in_year[tx_type] = in_year.get(tx_type, 0.0) + abs(amount)
+            if tx_type == "sell":
+                realized_gains += stored_gains.get(tx_id, amount)
+
+    components = {
+        "realized_gains": realized_gains,
+        "dividends": in_year.get("dividend", 0.0),
+        "interest": in_year.get("interest", 0.0),
+        "transaction_costs": in_year.get("cost", 0.0),
+    }
+    gestort_kapitaal = to_date.get("deposit", 0.0) - to_date.get("withdrawal", 0.0)
+    cash = (
+        gestort_kapitaal
+        + to_date.get("sell", 0.0) + to_date.get("dividend", 0.0) + to_date.get("interest", 0.0)
+        - to_date.get("buy", 0.0) - to_date.get("cost", 0.0)
+    )
+    return components, cash, gestort_kapitaal
+
+
+def bench_report(args):
+    """Annual report totals: Python pass over the ledger vs the rollup-fed ledger cache."""
+    from services.annual_report import _winst_verlies, _year_totals, generate_annual_report
+    from services.importer import bulk_insert_transactions
+    from services.rollups import rebuild
+
+    db, bv_id = _setup(args.db)
+    parsed = _fake_ledger(args.rows)
+    for i in range(0, len(parsed), args.batch):
+        bulk_insert_transactions(db, bv_id, parsed[i:i + args.batch])
+    db.commit()
+    del parsed
+    print(f"Annual report 2024 over {args.rows:,} transactions of one BV ({args.db})")
+
+    t0 = time.perf_counter()
+    legacy = _legacy_year_totals(db, bv_id, 2024)
+    _report("Python ledger pass", args.rows, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    totals = _year_totals(db, bv_id, 2024)
+    _report("ledger cache (rollups)", args.rows, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    generate_annual_report(db, bv_id, 2024)
+    _report("generate_annual_report", args.rows, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    rebuild(db, bv_id)
+    db.commit()
+    _report("rollup rebuild (SQL)", args.rows, time.perf_counter() - t0)
+    rebuilt = _year_totals(db, bv_id, 2024)
+
+    def rounded(result):
+        components, cash, gestort_kapitaal = result
+        return _winst_verlies(**components), round(cash, 2), round(gestort_kapitaal, 2)
+
+    print(f"  totals match to the cent: {rounded(legacy) == rounded(totals) == rounded(rebuilt)}")
+    db.close()
+
+
+BENCHMARKS = {
+    "insert": bench_insert,
+    "rules": bench_rules,
+    "read-models": bench_read_models,
+    "report": bench_report,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BoxShift benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--db", default="sqlite://")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,19 @@ SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-key")
 DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{os.path.join(BASE_DIR, 'data', 'boxshift.db')}")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
 
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "")  # e.g. stub_anthropic.py for local runs
+
+# Transaction classifier
+CLASSIFIER_CACHE_SIZE = int(os.getenv("CLASSIFIER_CACHE_SIZE", "10000"))  # in-memory entries in front of the DB cache
+CLASSIFIER_CHUNK_SIZE = int(os.getenv("CLASSIFIER_CHUNK_SIZE", "50"))  # rows per API request
+CLASSIFIER_CONCURRENCY = int(os.getenv("CLASSIFIER_CONCURRENCY", "4"))  # parallel API requests
+CLASSIFIER_MAX_RETRIES = int(os.getenv("CLASSIFIER_MAX_RETRIES", "2"))
+CLASSIFIER_BACKOFF = float(os.getenv("CLASSIFIER_BACKOFF", "0.5"))  # seconds, doubled per retry
+CLASSIFIER_TIMEOUT = float(os.getenv("CLASSIFIER_TIMEOUT", "30"))  # seconds per API request
+CLASSIFIER_MODEL_THRESHOLD = float(os.getenv("CLASSIFIER_MODEL_THRESHOLD", "0.95"))  # min confidence to skip the API
+CLASSIFIER_MODEL_MIN_SAMPLES = int(os.getenv("CLASSIFIER_MODEL_MIN_SAMPLES", "200"))  # labelled rows before the model is used
+CLASSIFIER_MODEL_TTL = float(os.getenv("CLASSIFIER_MODEL_TTL", "600"))  # seconds between background retrains
+
 # GitHub OAuth
 GITHUB_CLIENT_ID = os.getenv("GITHUB_CLIENT_ID", "")
 GITHUB_CLIENT_SECRET = os.getenv("GITHUB_CLIENT_SECRET", "")
@@ -23,3 +36,18 @@ ALLOW_DEMO_LOGIN = os.getenv("ALLOW_DEMO_LOGIN", "false").lower() == "true"
 # Resend (email)
 RESEND_API_KEY = os.getenv("RESEND_API_KEY", "")
 EMAIL_FROM = os.getenv("EMAIL_FROM", "BoxShift <noreply@boxshift.nl>")
+
+# Background imports
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "2"))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(BASE_DIR, "data", "uploads"))
+IMPORT_JOB_TTL = float(os.getenv("IMPORT_JOB_TTL", "300"))  # seconds without heartbeat before a running job is recovered
+
+# Columnar ledger copies kept in memory for reports and the dashboard (BVs per process)
+LEDGER_CACHE_SIZE = int(os.getenv("LEDGER_CACHE_SIZE", "256"))
+
+# Per-BV locks around imports, processing and report generation
+BV_LOCK_TIMEOUT = float(os.getenv("BV_LOCK_TIMEOUT", "300"))  # seconds background work waits for a busy BV
+BV_LOCK_TTL = float(os.getenv("BV_LOCK_TTL", "3600"))  # seconds without heartbeat before a lock counts as abandoned
+
+# Batch processing (python -m services.batch)
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 1)))
@@ -1,10 +1,53 @@
+from collections import Counter, defaultdict
 from datetime import date, datetime
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, Date, DateTime, Text, ForeignKey, JSON
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy import bindparam, create_engine, event, inspect, insert, select, text, Column, Integer, BigInteger, String, Float, Boolean, Date, DateTime, Text, ForeignKey, JSON, Index
+from sqlalchemy.orm import Session, declarative_base, relationship, sessionmaker
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.types import TypeDecorator
 
 Base = declarative_base()
 
 
+class ScaledInteger(TypeDecorator):
+    """A decimal number stored as a whole multiple of 1/scale.
+
+    Python code keeps reading and writing euros and shares as floats; the
+    database holds integers, so stored values and SQL sums are exact.
+    """
+
+    impl = BigInteger
+    cache_ok = True
+    scale = 1
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else round(value * self.scale)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else value / self.scale
+
+
+class Money(ScaledInteger):
+    """Euro amount stored as integer cents."""
+
+    cache_ok = True
+    scale = 100
+
+
+class Quantity(ScaledInteger):
+    """Number of shares stored in millionths, for fractional shares."""
+
+    cache_ok = True
+    scale = 1_000_000
+
+
+def to_cents(euros: float) -> int:
+    return round(euros * Money.scale)
+
+
+def from_cents(cents: int) -> float:
+    return cents / Money.scale
+
+
 class Lead(Base):
     __tablename__ = "leads"
 
@@ -42,6 +85,8 @@ class BV(Base):
     kvk_number = Column(String, nullable=True)
     oprichtingsdatum = Column(Date, nullable=True)
     status = Column(String, default="pending")  # pending / active / inactive
+    cost_method = Column(String, default="average")  # average / fifo — cost basis for realized gains
+    rollup_version = Column(Integer, nullable=True)  # bumped when the BV's transaction rollups change
 
     user = relationship("User", back_populates="bvs")
     transactions = relationship("Transaction", back_populates="bv")
@@ -59,16 +104,25 @@ class Transaction(Base):
     type = Column(String, nullable=False)  # buy / sell / dividend / interest / cost / deposit / withdrawal
     ticker = Column(String, nullable=True)
     description = Column(String, nullable=False)
-    quantity = Column(Float, nullable=True)
+    quantity = Column(Quantity, nullable=True)
     price = Column(Float, nullable=True)
-    amount = Column(Float, nullable=False)  # positive=in, negative=out
+    amount = Column(Money, nullable=False)  # positive=in, negative=out
     currency = Column(String, default="EUR")
     broker_ref = Column(String, nullable=True)
     category = Column(String, nullable=True)  # AI-classified
+    category_source = Column(String, nullable=True)  # parser / rules / model / api / fallback; only api trains the model
     processed = Column(Boolean, default=False)
+    fingerprint = Column(String, nullable=True)  # import dedup key, see services/importer.py
 
     bv = relationship("BV", back_populates="transactions")
 
+    __table_args__ = (
+        Index("ix_transactions_bv_fingerprint", "bv_id", "fingerprint", unique=True),
+        # Year/period filters are date ranges so these can serve them
+        Index("ix_transactions_bv_date", "bv_id", "date"),
+        Index("ix_transactions_bv_type_date", "bv_id", "type", "date"),
+    )
+
 
 class Holding(Base):
     __tablename__ = "holdings"
@@ -77,12 +131,108 @@ class Holding(Base):
     bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
     ticker = Column(String, nullable=False)
     name = Column(String, nullable=False)
-    quantity = Column(Float, default=0)
+    quantity = Column(Quantity, default=0)
     avg_cost_price = Column(Float, default=0)
-    total_cost = Column(Float, default=0)
+    total_cost = Column(Money, default=0)
 
     bv = relationship("BV", back_populates="holdings")
 
+    __table_args__ = (
+        Index("ix_holdings_bv_ticker", "bv_id", "ticker", unique=True),
+    )
+
+
+class Lot(Base):
+    __tablename__ = "lots"
+
+    id = Column(Integer, primary_key=True)
+    bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
+    ticker = Column(String, nullable=False)
+    buy_tx_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
+    date = Column(Date, nullable=False)
+    quantity = Column(Quantity, nullable=False)
+    cost = Column(Money, nullable=False)  # total cost of the buy, incl. fees
+    remaining_quantity = Column(Quantity, nullable=False)
+
+    __table_args__ = (
+        Index("ix_lots_bv_ticker_date", "bv_id", "ticker", "date"),
+    )
+
+
+class RealizedGain(Base):
+    __tablename__ = "realized_gains"
+
+    id = Column(Integer, primary_key=True)
+    bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
+    ticker = Column(String, nullable=False)
+    sell_tx_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
+    date = Column(Date, nullable=False)
+    quantity = Column(Quantity, nullable=False)
+    proceeds = Column(Money, nullable=False)
+    cost_basis = Column(Money, nullable=False)
+    gain = Column(Money, nullable=False)
+    method = Column(String, nullable=False)  # average / fifo
+
+    __table_args__ = (
+        Index("ix_realized_gains_bv_ticker_date", "bv_id", "ticker", "date"),
+        Index("ix_realized_gains_bv_date", "bv_id", "date"),
+    )
+
+
+class TransactionRollup(Base):
+    __tablename__ = "transaction_rollups"
+
+    id = Column(Integer, primary_key=True)
+    bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    type = Column(String, nullable=False)
+    tx_count = Column(Integer, nullable=False, default=0)
+    amount = Column(Money, nullable=False, default=0)  # signed sum
+    abs_amount = Column(Money, nullable=False, default=0)  # sum of abs(amount)
+    gain_adjustment = Column(Money, nullable=False, default=0)  # sells: stored gain - proceeds, see services/rollups.py
+
+    __table_args__ = (
+        Index("ix_transaction_rollups_bv_year_month_type", "bv_id", "year", "month", "type", unique=True),
+    )
+
+
+@event.listens_for(Session, "after_flush")
+def _rollup_new_transactions(session, flush_context):
+    # Transactions added through the ORM (seed data, scripts), recorded once per
+    # flush; the bulk import path records its rows itself
+    new = defaultdict(list)
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            new[obj.bv_id].append({"date": obj.date, "type": obj.type, "amount": obj.amount})
+    if new:
+        from services.rollups import record_transactions
+        for bv_id, rows in new.items():
+            record_transactions(session.connection(), bv_id, rows)
+
+
+class HoldingCheckpoint(Base):
+    __tablename__ = "holding_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
+    as_of = Column(Date, nullable=False)  # last day of the month
+    positions = Column(JSON)  # {ticker: {name, quantity, avg_cost_price, total_cost}}
+    lots = Column(JSON)  # [[ticker, buy_tx_id, date, quantity, cost, remaining_quantity], ...]
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_holding_checkpoints_bv_as_of", "bv_id", "as_of", unique=True),
+    )
+
+
+class BVLock(Base):
+    __tablename__ = "bv_locks"
+
+    bv_id = Column(Integer, ForeignKey("bvs.id"), primary_key=True)
+    owner = Column(String, nullable=False)  # host:pid:thread, see services/locks.py
+    acquired_at = Column(DateTime, nullable=False)
+
 
 class AnnualReport(Base):
     __tablename__ = "annual_reports"
@@ -94,6 +244,7 @@ class AnnualReport(Base):
     winst_verlies = Column(JSON, nullable=True)
     status = Column(String, default="draft")  # draft / final
     generated_at = Column(DateTime, default=datetime.utcnow)
+    fingerprint = Column(String, nullable=True)  # hash of the inputs, see services/annual_report.py
 
     bv = relationship("BV", back_populates="annual_reports")
 
@@ -104,15 +255,238 @@ class VPBFiling(Base):
     id = Column(Integer, primary_key=True)
     bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
     year = Column(Integer, nullable=False)
-    taxable_profit = Column(Float, default=0)
-    vpb_amount = Column(Float, default=0)
+    taxable_profit = Column(Money, default=0)
+    vpb_amount = Column(Money, default=0)
     status = Column(String, default="draft")  # draft / ready / filed
 
     bv = relationship("BV", back_populates="vpb_filings")
 
 
+class Instrument(Base):
+    __tablename__ = "instruments"
+
+    id = Column(Integer, primary_key=True)
+    isin = Column(String, unique=True, nullable=False)
+    ticker = Column(String, nullable=False)
+    exchange_suffix = Column(String, nullable=True)  # default listing, e.g. ".AS"
+    name = Column(String, nullable=True)
+    currency = Column(String, default="EUR")
+
+
+class ClassificationCache(Base):
+    __tablename__ = "classification_cache"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True, nullable=False)  # see services/ai_classifier.cache_key
+    type = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ImportedFile(Base):
+    __tablename__ = "imported_files"
+
+    id = Column(Integer, primary_key=True)
+    bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
+    sha256 = Column(String, nullable=False)
+    broker = Column(String, nullable=True)
+    rows = Column(Integer, default=0)
+    imported_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_imported_files_bv_sha256", "bv_id", "sha256", unique=True),
+    )
+
+
+class ImportJob(Base):
+    __tablename__ = "import_jobs"
+
+    id = Column(Integer, primary_key=True)
+    bv_id = Column(Integer, ForeignKey("bvs.id"), nullable=False)
+    broker = Column(String, default="degiro")
+    file_path = Column(String, nullable=False)
+    status = Column(String, default="queued")  # queued / running / done / failed
+    rows_parsed = Column(Integer, default=0)
+    rows_classified = Column(Integer, default=0)
+    rows_skipped = Column(Integer, default=0)
+    rows_processed = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    worker = Column(String, nullable=True)  # host:pid running the job, see services/jobs.py
+    heartbeat_at = Column(DateTime, nullable=True)  # refreshed by the worker while the job runs
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
 def init_db(database_url):
     engine = create_engine(database_url)
     Base.metadata.create_all(engine)
+    _migrate(engine)
     Session = sessionmaker(bind=engine)
     return engine, Session
+
+
+def _migrate(engine):
+    """Bring existing tables up to date with the models.
+
+    create_all() only creates missing tables; this adds columns and indexes
+    that were introduced after a table was first created. Added columns must
+    be nullable so existing rows stay valid. Data migrations run once and
+    are recorded in schema_migrations, before the indexes are created so
+    they can clean up rows a new unique index would reject.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+
+        applied = set(conn.execute(select(SchemaMigration.name)).scalars())
+        for name, migration in _DATA_MIGRATIONS:
+            if name not in applied:
+                migration(conn)
+                conn.execute(insert(SchemaMigration).values(name=name, applied_at=datetime.utcnow()))
+
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def _scale_to_integers(conn):
+    """Convert float money and quantity columns to scaled integers (cents, millionths).
+
+    Only columns still declared as a non-integer type are converted, so the
+    values are never rescaled twice, even if schema_migrations was lost.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        declared = {c["name"]: c["type"] for c in inspector.get_columns(table.name)}
+        columns = [
+            column for column in table.columns
+            if isinstance(column.type, ScaledInteger) and not isinstance(declared[column.name], Integer)
+        ]
+        if not columns:
+            continue
+        if conn.dialect.name == "postgresql":
+            for column in columns:
+                conn.execute(text(
+                    f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT "
+                    f"USING ROUND({column.name} * {column.type.scale})"
+                ))
+        else:
+            _rebuild_sqlite_table(conn, inspector, table, columns)
+
+
+def _rebuild_sqlite_table(conn, inspector, table, scaled):
+    """Recreate a SQLite table with the model's column types, scaling `scaled` columns.
+
+    SQLite cannot change a column's type, so the table is renamed, created
+    afresh and copied. Indexes the old table had are recreated; new ones are
+    left to _migrate.
+    """
+    old = f"{table.name}_float"
+    indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    # Keep other tables' foreign keys pointing at the original name
+    conn.execute(text("PRAGMA legacy_alter_table = ON"))
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old}"))
+    for name in indexes:
+        conn.execute(text(f"DROP INDEX {name}"))
+    conn.execute(CreateTable(table))
+
+    scales = {column.name: column.type.scale for column in scaled}
+    names = [column.name for column in table.columns]
+    values = [f"ROUND({name} * {scales[name]})" if name in scales else name for name in names]
+    conn.execute(text(
+        f"INSERT INTO {table.name} ({', '.join(names)}) SELECT {', '.join(values)} FROM {old}"
+    ))
+    conn.execute(text(f"DROP TABLE {old}"))
+    conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+    for index in table.indexes:
+        if index.name in indexes:
+            index.create(conn)
+
+
+def _merge_duplicate_holdings(conn):
+    """Merge holdings rows with the same (bv_id, ticker) into the oldest one."""
+    table = Holding.__table__
+    rows = conn.execute(
+        select(table.c.id, table.c.bv_id, table.c.ticker, table.c.quantity, table.c.total_cost)
+        .order_by(table.c.id)
+    )
+    merged, duplicates = {}, []
+    for row in rows:
+        key = (row.bv_id, row.ticker)
+        if key in merged:
+            kept = merged[key]
+            kept["quantity"] = (kept["quantity"] or 0) + (row.quantity or 0)
+            kept["total_cost"] = (kept["total_cost"] or 0) + (row.total_cost or 0)
+            kept["changed"] = True
+            duplicates.append(row.id)
+        else:
+            merged[key] = {"id": row.id, "quantity": row.quantity, "total_cost": row.total_cost, "changed": False}
+    if not duplicates:
+        return
+
+    for kept in merged.values():
+        if kept["changed"]:
+            quantity = kept["quantity"]
+            conn.execute(table.update().where(table.c.id == kept["id"]).values(
+                quantity=quantity,
+                total_cost=kept["total_cost"],
+                avg_cost_price=kept["total_cost"] / quantity if quantity else 0.0,
+            ))
+    conn.execute(table.delete().where(table.c.id.in_(duplicates)))
+
+
+def _build_rollups(conn):
+    """Fill transaction_rollups for databases that predate it."""
+    from services.rollups import rebuild
+    rebuild(conn)
+
+
+def _refingerprint(conn):
+    """Recompute import fingerprints with the current key (services/importer.py).
+
+    Occurrences are numbered per BV and key in insertion order, as an
+    import numbers them per file.
+    """
+    from services.importer import transaction_fingerprint
+
+    tx = Transaction.__table__
+    rows = conn.execute(
+        select(tx.c.id, tx.c.bv_id, tx.c.broker_ref, tx.c.date, tx.c.amount, tx.c.currency,
+               tx.c.ticker, tx.c.description)
+        .where(tx.c.fingerprint.is_not(None))
+        .order_by(tx.c.bv_id, tx.c.id)
+    ).mappings()
+    counts, current_bv, updates = Counter(), None, []
+    for row in rows:
+        if row["bv_id"] != current_bv:
+            counts.clear()
+            current_bv = row["bv_id"]
+        base = transaction_fingerprint(row)
+        updates.append({"b_id": row["id"], "b_fingerprint": transaction_fingerprint(row, counts[base])})
+        counts[base] += 1
+    if updates:
+        conn.execute(
+            tx.update().where(tx.c.id == bindparam("b_id")).values(fingerprint=bindparam("b_fingerprint")),
+            updates,
+        )
+
+
+# One-off data migrations, applied in order and recorded in schema_migrations
+_DATA_MIGRATIONS = [
+    ("scaled_integer_money", _scale_to_integers),
+    ("unique_holdings", _merge_duplicate_holdings),
+    ("transaction_rollups", _build_rollups),
+    ("fingerprint_currency_description", _refingerprint),
+]
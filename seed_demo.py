@@ -9,7 +9,7 @@ import random
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 import config
-from models import Base, Lead, User, BV, Transaction, Holding, init_db
+from models import Base, Lead, User, BV, Transaction, Holding, SchemaMigration, init_db
 from services.transaction_engine import process_transactions
 
 # Init DB
@@ -20,9 +20,10 @@ engine, Session = init_db(config.DATABASE_URL)
 def seed():
     db = Session()
 
-    # Clean existing data
+    # Clean existing data; keep the migration log so data migrations don't run again
     for table in reversed(Base.metadata.sorted_tables):
-        db.execute(table.delete())
+        if table is not SchemaMigration.__table__:
+            db.execute(table.delete())
     db.commit()
 
     print("Seeding demo data...")
@@ -1,37 +1,404 @@
 """AI-powered transaction classifier using Claude API."""
 
 import os
+import re
 import json
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
 
+import config
 
-def classify_transactions(transactions: list[dict]) -> list[dict]:
-    """Classify a batch of transactions using Claude API.
+VALID_TYPES = ("buy", "sell", "dividend", "interest", "cost", "deposit", "withdrawal")
+
+
+class _LRUCache:
+    """Small thread-safe LRU map: normalized key -> transaction type."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_cache = _LRUCache(config.CLASSIFIER_CACHE_SIZE)
+_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "api_calls": 0, "api_retries": 0, "api_failures": 0}
+# tier -> [rows, seconds]; tiers run in this order
+_tier_stats = {tier: [0, 0.0] for tier in ("cache", "rules", "model", "api", "fallback")}
+_stats_lock = threading.Lock()
+
+
+def _count(**increments):
+    with _stats_lock:
+        for name, n in increments.items():
+            _stats[name] += n
+
+
+def _count_tier(tier: str, rows: int, seconds: float):
+    with _stats_lock:
+        _tier_stats[tier][0] += rows
+        _tier_stats[tier][1] += seconds
+
+
+def classification_stats() -> dict:
+    """Process-wide cache and per-tier counters since startup."""
+    with _stats_lock:
+        stats = dict(_stats)
+        tiers = {tier: list(v) for tier, v in _tier_stats.items()}
+    stats["memory_size"] = len(_cache)
+    stats["model_samples"] = _model.samples
+    stats["tiers"] = {
+        tier: {
+            "rows": rows,
+            "ms": round(seconds * 1000, 1),
+            "us_per_row": round(seconds * 1e6 / rows, 1) if rows else None,
+        }
+        for tier, (rows, seconds) in tiers.items()
+    }
+    return stats
+
+
+def cache_key(tx: dict) -> str:
+    """Normalized description plus the numeric shape that decides the type.
+
+    Digits are masked so "Dividend 12-03-2025" and "Dividend 14-06-2025"
+    share a key; sign and trade-ness separate a buy from a sell of the same
+    product.
+    """
+    desc = re.sub(r"\d", "#", " ".join(tx.get("description", "").lower().split()))
+    sign = "-" if (tx.get("amount") or 0) < 0 else "+"
+    trade = "t" if tx.get("quantity") and tx.get("price") else ""
+    return f"{desc}|{sign}{trade}"
+
+
+def classify_transactions(transactions: list[dict], db=None, broker: str | None = None) -> list[dict]:
+    """Classify a batch of transactions, cheapest tier first.
 
     Each transaction dict should have: description, amount, quantity, price.
-    Returns the same list with 'type' field added/updated.
+    Returns the same list with 'type' field added/updated, and 'type_source'
+    set to the tier that decided it ("api" for cache hits, which only hold
+    API answers).
+
+    Tiers:
+      cache     in-memory LRU, then the classification_cache table (needs `db`)
+      rules     trade shape (quantity + price) or a keyword rule match
+      model     naive Bayes trained on API-labelled transactions (see
+                start_model_trainer), used only above
+                CLASSIFIER_MODEL_THRESHOLD confidence
+      api       Claude, one representative per distinct description; cached
+      fallback  rule-based default when the API is unavailable or failed
 
-    Falls back to rule-based classification if API is unavailable.
+    `broker` selects broker-specific keyword rules.
     """
-    api_key = os.getenv("ANTHROPIC_API_KEY", "")
+    t0 = time.perf_counter()
+
+    # key -> rows still waiting for a type
+    pending = {}
+    memory_hits = 0
+    for tx in transactions:
+        key = cache_key(tx)
+        cached = _cache.get(key)
+        if cached:
+            tx["type"] = cached
+            tx["type_source"] = "api"
+            memory_hits += 1
+        else:
+            pending.setdefault(key, []).append(tx)
+
+    db_hits = 0
+    if pending and db is not None:
+        from models import ClassificationCache
+        rows = db.execute(
+            select(ClassificationCache.key, ClassificationCache.type)
+            .where(ClassificationCache.key.in_(list(pending)))
+        ).all()
+        for key, tx_type in rows:
+            _cache.put(key, tx_type)
+            for tx in pending.pop(key):
+                tx["type"] = tx_type
+                tx["type_source"] = "api"
+                db_hits += 1
+
+    missed = sum(len(txs) for txs in pending.values())
+    _count(memory_hits=memory_hits, db_hits=db_hits, misses=missed)
+    t1 = time.perf_counter()
+    _count_tier("cache", len(transactions) - missed, t1 - t0)
+    if not pending:
+        return transactions
+
+    # Local tiers work on one representative per key, since all rows of a
+    # key share description and shape; answers are copied to the rest
+    keys = list(pending)
+    reps = [pending[key][0] for key in keys]
 
+    unsure = {id(tx) for tx in _apply_rules(reps, broker)}
+    done = [key for key in keys if id(pending[key][0]) not in unsure]
+    _spread(pending, done, "rules")
+    t2 = time.perf_counter()
+    _count_tier("rules", _rows(pending, done), t2 - t1)
+
+    unsure_reps = [tx for tx in reps if id(tx) in unsure]
+    still_unsure = {id(tx) for tx in _model.classify(unsure_reps)}
+    done = [key for key in keys if id(pending[key][0]) in unsure and id(pending[key][0]) not in still_unsure]
+    _spread(pending, done, "model")
+    t3 = time.perf_counter()
+    _count_tier("model", _rows(pending, done), t3 - t2)
+
+    keys = [key for key in keys if id(pending[key][0]) in still_unsure]
+    if not keys:
+        return transactions
+
+    api_key = os.getenv("ANTHROPIC_API_KEY", "")
     if not api_key or api_key.startswith("sk-ant-..."):
-        return _rule_based_classify(transactions)
+        _rule_based_classify([tx for key in keys for tx in pending[key]], broker)
+        _count_tier("fallback", _rows(pending, keys), time.perf_counter() - t3)
+        return transactions
 
-    try:
-        import anthropic
-        client = anthropic.Anthropic(api_key=api_key)
-
-        # Batch transactions for efficiency
-        tx_descriptions = []
-        for i, tx in enumerate(transactions):
-            tx_descriptions.append(
-                f"{i}: desc=\"{tx.get('description', '')}\", "
-                f"amount={tx.get('amount', 0)}, "
-                f"qty={tx.get('quantity', '')}, "
-                f"price={tx.get('price', '')}"
+    types = _api_classify([pending[key][0] for key in keys], api_key)
+
+    learned = {}
+    unresolved = []
+    for i, key in enumerate(keys):
+        tx_type = types.get(i)
+        if tx_type:
+            learned[key] = tx_type
+            _cache.put(key, tx_type)
+            for tx in pending[key]:
+                tx["type"] = tx_type
+                tx["type_source"] = "api"
+        else:
+            unresolved.append(key)
+
+    if learned and db is not None:
+        _store(db, learned)
+    t4 = time.perf_counter()
+    _count_tier("api", _rows(pending, learned), t4 - t3)
+
+    # Rows whose chunk failed degrade to rules; those answers aren't cached
+    if unresolved:
+        _rule_based_classify([tx for key in unresolved for tx in pending[key]], broker)
+        _count_tier("fallback", _rows(pending, unresolved), time.perf_counter() - t4)
+
+    return transactions
+
+
+def _rows(pending: dict, keys) -> int:
+    return sum(len(pending[key]) for key in keys)
+
+
+def _spread(pending: dict, keys, source: str):
+    """Copy each key's representative type to the key's other rows, noting its source."""
+    for key in keys:
+        first, *rest = pending[key]
+        first["type_source"] = source
+        for tx in rest:
+            tx["type"] = first["type"]
+            tx["type_source"] = source
+
+
+class _LocalModel:
+    """Multinomial naive Bayes over description words and amount sign.
+
+    Trained on (description, sign, category) counts aggregated in the
+    database, so training cost depends on distinct descriptions, not rows.
+    Only categories the API assigned are used; rules, fallback guesses and
+    the model's own answers would otherwise reinforce themselves.
+    Predicts only when the posterior clears CLASSIFIER_MODEL_THRESHOLD.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.trained_at = 0.0
+        # (log prior per type, {type: {token: log p(token | type)}},
+        #  log p(unseen token | type), vocabulary); replaced as a whole
+        self._params = ({}, {}, {}, frozenset())
+
+    @staticmethod
+    def features(tx: dict) -> list[str]:
+        desc = tx.get("description", "").lower()
+        sign = "sign:-" if (tx.get("amount") or 0) < 0 else "sign:+"
+        return re.findall(r"[a-z]{2,}", desc) + [sign]
+
+    def train(self, db):
+        from models import Transaction
+        from sqlalchemy import func
+
+        negative = Transaction.amount < 0
+        rows = db.execute(
+            select(Transaction.description, negative, Transaction.category, func.count())
+            .where(Transaction.category_source == "api", Transaction.category.in_(VALID_TYPES))
+            .group_by(Transaction.description, negative, Transaction.category)
+        ).all()
+
+        class_counts = Counter()
+        token_counts = {}
+        for description, is_negative, category, n in rows:
+            class_counts[category] += n
+            counts = token_counts.setdefault(category, Counter())
+            for token in self.features({"description": description, "amount": -1 if is_negative else 1}):
+                counts[token] += n
+
+        vocabulary = set().union(*token_counts.values()) if token_counts else set()
+        total = sum(class_counts.values())
+        log_prior, log_likelihood, log_unseen = {}, {}, {}
+        for tx_type, n in class_counts.items():
+            counts = token_counts[tx_type]
+            denominator = sum(counts.values()) + len(vocabulary) + 1
+            log_prior[tx_type] = math.log(n / total)
+            log_likelihood[tx_type] = {token: math.log((c + 1) / denominator) for token, c in counts.items()}
+            log_unseen[tx_type] = math.log(1 / denominator)
+
+        self._params = (log_prior, log_likelihood, log_unseen, frozenset(vocabulary))
+        self.samples = total
+        self.trained_at = time.monotonic()
+
+    def classify(self, transactions: list[dict]) -> list[dict]:
+        """Set 'type' where the model is confident; return the other rows."""
+        log_prior, log_likelihood, log_unseen, vocabulary = self._params
+        if self.samples < config.CLASSIFIER_MODEL_MIN_SAMPLES or len(log_prior) < 2:
+            return transactions
+
+        uncertain = []
+        for tx in transactions:
+            tokens = self.features(tx)
+            # The sign alone is no evidence; require a known description word
+            if not any(t in vocabulary for t in tokens[:-1]):
+                uncertain.append(tx)
+                continue
+            scores = {
+                tx_type: prior + sum(log_likelihood[tx_type].get(t, log_unseen[tx_type]) for t in tokens)
+                for tx_type, prior in log_prior.items()
+            }
+            best = max(scores, key=scores.get)
+            top = scores[best]
+            confidence = 1 / sum(math.exp(score - top) for score in scores.values())
+            if confidence >= config.CLASSIFIER_MODEL_THRESHOLD:
+                tx["type"] = best
+            else:
+                uncertain.append(tx)
+        return uncertain
+
+
+_model = _LocalModel()
+_trainer = None
+
+
+def start_model_trainer(session_factory):
+    """Train the local model now and every CLASSIFIER_MODEL_TTL seconds, in a daemon thread.
+
+    Training aggregates the labelled transactions of all BVs, so it runs
+    here rather than in an import.
+    """
+    global _trainer
+    if _trainer:
+        return
+
+    def run():
+        while True:
+            db = session_factory()
+            try:
+                _model.train(db)
+            except Exception:
+                # Keep the previous model; the next round tries again
+                pass
+            finally:
+                db.close()
+            time.sleep(config.CLASSIFIER_MODEL_TTL)
+
+    _trainer = threading.Thread(target=run, name="classifier-trainer", daemon=True)
+    _trainer.start()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _get_client(api_key: str):
+    """Shared Anthropic client; its HTTP connection pool is reused by all chunks."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import anthropic
+            _client = anthropic.Anthropic(
+                api_key=api_key,
+                base_url=config.ANTHROPIC_BASE_URL or None,
+                max_retries=0,  # retries/backoff are handled per chunk below
+                timeout=config.CLASSIFIER_TIMEOUT,
             )
+        return _client
+
+
+def _api_classify(transactions: list[dict], api_key: str) -> dict[int, str]:
+    """Classify via Claude in concurrent chunks. Returns {index: type}.
+
+    Chunks of CLASSIFIER_CHUNK_SIZE rows keep each JSON answer well inside
+    max_tokens. At most CLASSIFIER_CONCURRENCY requests run at once. A chunk
+    that still fails after retries is left out of the result, so only its
+    own rows fall back to rules.
+    """
+    size = config.CLASSIFIER_CHUNK_SIZE
+    chunks = [(start, transactions[start:start + size]) for start in range(0, len(transactions), size)]
+    client = _get_client(api_key)
+
+    types = {}
+    if len(chunks) == 1:
+        results = [_classify_chunk_with_retry(client, *chunks[0])]
+    else:
+        workers = min(config.CLASSIFIER_CONCURRENCY, len(chunks))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="classify") as pool:
+            results = list(pool.map(lambda chunk: _classify_chunk_with_retry(client, *chunk), chunks))
+    for chunk_types in results:
+        types.update(chunk_types)
+    return types
+
 
-        prompt = f"""Classify these broker transactions into types.
+def _classify_chunk_with_retry(client, offset: int, chunk: list[dict]) -> dict[int, str]:
+    """Classify one chunk with exponential backoff. Returns {} if it keeps failing."""
+    for attempt in range(config.CLASSIFIER_MAX_RETRIES + 1):
+        try:
+            return {offset + i: tx_type for i, tx_type in _classify_chunk(client, chunk).items()}
+        except Exception:
+            if attempt == config.CLASSIFIER_MAX_RETRIES:
+                _count(api_failures=1)
+                return {}
+            _count(api_retries=1)
+            time.sleep(config.CLASSIFIER_BACKOFF * 2 ** attempt)
+
+
+def _classify_chunk(client, transactions: list[dict]) -> dict[int, str]:
+    """Ask Claude for the type of each transaction in one chunk. Returns {index: type}."""
+    # Batch transactions for efficiency
+    tx_descriptions = []
+    for i, tx in enumerate(transactions):
+        tx_descriptions.append(
+            f"{i}: desc=\"{tx.get('description', '')}\", "
+            f"amount={tx.get('amount', 0)}, "
+            f"qty={tx.get('quantity', '')}, "
+            f"price={tx.get('price', '')}"
+        )
+
+    prompt = f"""Classify these broker transactions into types.
 Valid types: buy, sell, dividend, interest, cost, deposit, withdrawal
 
 Transactions:
@@ -39,50 +406,157 @@ Transactions:
 
 Return JSON array with objects having "index" and "type" fields. Only return the JSON, nothing else."""
 
-        message = client.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=1024,
-            messages=[{"role": "user", "content": prompt}],
-        )
+    _count(api_calls=1)
+    message = client.messages.create(
+        model="claude-haiku-4-5-20251001",
+        # ~20 output tokens per {"index": n, "type": "..."} object, plus slack
+        max_tokens=64 + 24 * len(transactions),
+        messages=[{"role": "user", "content": prompt}],
+    )
 
-        result = json.loads(message.content[0].text)
-        for item in result:
-            idx = item["index"]
-            if 0 <= idx < len(transactions):
-                transactions[idx]["type"] = item["type"]
+    result = json.loads(message.content[0].text)
+    return {
+        item["index"]: item["type"]
+        for item in result
+        if 0 <= item["index"] < len(transactions) and item["type"] in VALID_TYPES
+    }
 
-    except Exception:
-        return _rule_based_classify(transactions)
 
-    return transactions
+def _store(db, learned: dict[str, str]):
+    """Persist newly learned key -> type pairs; concurrent writers may race."""
+    from models import ClassificationCache
+
+    existing = set(db.execute(
+        select(ClassificationCache.key).where(ClassificationCache.key.in_(list(learned)))
+    ).scalars())
+    new = [{"key": key, "type": tx_type} for key, tx_type in learned.items() if key not in existing]
+    if not new:
+        return
+    try:
+        with db.begin_nested():
+            db.execute(insert(ClassificationCache), new)
+    except IntegrityError:
+        pass  # Another import cached the same keys first
+
+
+# Keyword rules for the fallback classifier, in order of precedence: when a
+# description matches several rules, the earliest rule wins.
+CLASSIFICATION_RULES = [
+    ("dividend", ["dividend"]),
+    ("interest", ["rente", "interest"]),
+    ("cost", ["kosten", "fee", "commission"]),
+    ("deposit", ["storting", "deposit"]),
+    ("withdrawal", ["opname", "withdrawal"]),
+]
+
+# Broker-specific rules, checked before CLASSIFICATION_RULES. Extend with add_rules().
+BROKER_RULES = {
+    # IB withholding rows read "AAPL(US...) Cash Dividend USD 0.25 per Share - US Tax"
+    "ib": [("cost", ["withholding", " tax"])],
+}
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+def add_rules(broker: str, rules: list[tuple[str, list[str]]]):
+    """Register extra (type, keywords) rules for a broker, ahead of the defaults."""
+    for tx_type, _ in rules:
+        if tx_type not in VALID_TYPES:
+            raise ValueError(f"Unknown transaction type: {tx_type}")
+    with _matchers_lock:
+        BROKER_RULES.setdefault(broker, []).extend(rules)
+        _matchers.pop(broker, None)
+
+
+class _KeywordMatcher:
+    """All rule keywords of a broker, compiled into one regex over a keyword trie.
+
+    At each position the trie regex follows one path of literal characters,
+    so a search costs the same however many rules there are. It matches the
+    longest keyword starting at a position; each keyword maps to the best
+    rule among the keywords it contains, so shorter keywords at the same
+    position are not lost. Searching again from every match start finds the
+    overlapping ones. match() returns the type of the highest-precedence
+    (earliest) rule with a keyword in the text, like checking the rules in
+    order would.
+    """
+
+    def __init__(self, rules: list[tuple[str, list[str]]]):
+        self.types = [tx_type for tx_type, _ in rules]
+        keywords = [(n, keyword.lower()) for n, (_, rule_keywords) in enumerate(rules) for keyword in rule_keywords]
+        trie = {}
+        for _, keyword in keywords:
+            node = trie
+            for ch in keyword:
+                node = node.setdefault(ch, {})
+            node[""] = {}  # a keyword ends here
+        self.pattern = re.compile(_trie_pattern(trie)) if trie else None
+        self.rule = {keyword: min(n for n, other in keywords if other in keyword) for _, keyword in keywords}
+
+    def match(self, text: str) -> str:
+        """Type of the best matching rule for a lowercased text, or "" if none matches."""
+        best = len(self.types)
+        m = self.pattern.search(text) if self.pattern else None
+        while m and best:
+            best = min(best, self.rule[m.group()])
+            m = self.pattern.search(text, m.start() + 1)
+        return self.types[best] if best < len(self.types) else ""
 
 
-def _rule_based_classify(transactions: list[dict]) -> list[dict]:
-    """Simple rule-based fallback classifier."""
+def _trie_pattern(node: dict) -> str:
+    """Regex for a keyword trie; optional tails are greedy, so the longest keyword wins."""
+    branches = [re.escape(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    return f"(?:{body})?" if "" in node else body
+
+
+def _matcher(broker: str | None) -> _KeywordMatcher:
+    """Compile a broker's rule table into one keyword matcher (cached)."""
+    with _matchers_lock:
+        compiled = _matchers.get(broker)
+        if compiled is None:
+            compiled = _KeywordMatcher(BROKER_RULES.get(broker, []) + CLASSIFICATION_RULES)
+            _matchers[broker] = compiled
+        return compiled
+
+
+def _apply_rules(transactions: list[dict], broker: str | None = None) -> list[dict]:
+    """Set 'type' from trade shape or a keyword rule; return rows neither decides.
+
+    One pass over the batch. Each distinct description is searched by the
+    broker's keyword matcher once; repeats (the common case in broker
+    exports) are a dict hit.
+    """
+    matcher = _matcher(broker)
+    rule_for = {}
+    undecided = []
+
     for tx in transactions:
-        desc = tx.get("description", "").lower()
         amount = tx.get("amount", 0)
-        qty = tx.get("quantity")
-        price = tx.get("price")
+        if tx.get("quantity") and tx.get("price"):
+            tx["type"] = "buy" if amount < 0 else "sell"
+            continue
 
-        if qty and price:
-            if amount < 0:
-                tx["type"] = "buy"
-            else:
-                tx["type"] = "sell"
-        elif "dividend" in desc:
-            tx["type"] = "dividend"
-        elif "rente" in desc or "interest" in desc:
-            tx["type"] = "interest"
-        elif "kosten" in desc or "fee" in desc or "commission" in desc:
-            tx["type"] = "cost"
-        elif "storting" in desc or "deposit" in desc:
-            tx["type"] = "deposit"
-        elif "opname" in desc or "withdrawal" in desc:
-            tx["type"] = "withdrawal"
-        elif amount > 0:
-            tx["type"] = "deposit"
+        desc = tx.get("description", "")
+        tx_type = rule_for.get(desc)
+        if tx_type is None:
+            tx_type = rule_for[desc] = matcher.match(desc.lower())
+
+        if tx_type:
+            tx["type"] = tx_type
         else:
-            tx["type"] = "cost"
+            undecided.append(tx)
 
+    return undecided
+
+
+def _rule_based_classify(transactions: list[dict], broker: str | None = None) -> list[dict]:
+    """Rule-based fallback classifier: rules, then the sign of the amount."""
+    for tx in _apply_rules(transactions, broker):
+        tx["type"] = "deposit" if tx.get("amount", 0) > 0 else "cost"
+    for tx in transactions:
+        tx["type_source"] = "fallback"
     return transactions
@@ -1,45 +1,154 @@
 """Generate jaarrekening (annual report) for a beleggings-BV."""
 
-from datetime import datetime
+import hashlib
+from datetime import date, datetime
+from typing import Iterable
+from sqlalchemy import BigInteger, cast, func, select
 from sqlalchemy.orm import Session
-from sqlalchemy import extract
-from models import Transaction, Holding, AnnualReport, VPBFiling
+from models import AnnualReport, BV, HoldingCheckpoint, Transaction, TransactionRollup, VPBFiling
 
+# Part of every report fingerprint; bump when the report calculation changes
+# so existing reports are regenerated
+REPORT_VERSION = 1
 
-def generate_annual_report(db: Session, bv_id: int, year: int) -> AnnualReport:
-    """Generate balans + winst & verliesrekening for a given year."""
 
-    # Get all processed transactions for this year
-    txs = (
-        db.query(Transaction)
-        .filter(
-            Transaction.bv_id == bv_id,
-            extract("year", Transaction.date) == year,
-        )
-        .order_by(Transaction.date)
-        .all()
+def generate_annual_report(db: Session, bv_id: int, year: int, force: bool = False) -> AnnualReport:
+    """Generate balans + winst & verliesrekening for a given year.
+
+    Skipped when the stored report's fingerprint shows that none of its
+    inputs changed since it was generated, unless `force`.
+    """
+    fingerprint = report_fingerprint(db, bv_id, year)
+    report = db.query(AnnualReport).filter_by(bv_id=bv_id, year=year).first()
+    vpb_filing = db.query(VPBFiling).filter_by(bv_id=bv_id, year=year).first()
+    if not force and _up_to_date(report, vpb_filing, fingerprint):
+        return report
+
+    components, cash, gestort_kapitaal = _year_totals(db, bv_id, year)
+    wv = _winst_verlies(**components)
+    vpb_amount = _add_vpb(wv)
+
+    # Build balans
+    balans = _calculate_balans(db, bv_id, year, wv, cash, gestort_kapitaal)
+
+    report = _store_report(db, bv_id, year, balans, wv, vpb_amount, report, vpb_filing, fingerprint)
+    db.commit()
+    return report
+
+
+def generate_annual_reports(db: Session, bv_id: int, years: Iterable[int],
+                            force: bool = False) -> list[AnnualReport]:
+    """Generate the reports (and VPB filings) of several years in one pass.
+
+    Same figures as generate_annual_report per year, but the BV's columnar
+    ledger is fetched once for all years (liquide middelen and gestort
+    kapitaal are cumulative; winstreserve follows from them on each balans),
+    and year-end positions come from holdings_at in one go. Years whose
+    report is up to date (see report_fingerprint) are skipped unless
+    `force`. Commits once. Returns the reports in year order.
+    """
+    from services.ledger_cache import get_ledger
+    from services.transaction_engine import holdings_at
+
+    years = sorted(set(years))
+    if not years:
+        return []
+    existing_reports = {r.year: r for r in db.query(AnnualReport).filter(
+        AnnualReport.bv_id == bv_id, AnnualReport.year.in_(years))}
+    existing_filings = {f.year: f for f in db.query(VPBFiling).filter(
+        VPBFiling.bv_id == bv_id, VPBFiling.year.in_(years))}
+    fingerprints = {year: report_fingerprint(db, bv_id, year) for year in years}
+    stale = [
+        year for year in years
+        if force or not _up_to_date(existing_reports.get(year), existing_filings.get(year), fingerprints[year])
+    ]
+    if not stale:
+        return [existing_reports[year] for year in years]
+
+    ledger = get_ledger(db, bv_id)
+    positions = holdings_at(db, bv_id, [date(year, 12, 31) for year in stale])
+
+    reports = []
+    for year in years:
+        if year not in stale:
+            reports.append(existing_reports[year])
+            continue
+
+        components, cash, gestort_kapitaal = _figures(ledger, year)
+        wv = _winst_verlies(**components)
+        vpb_amount = _add_vpb(wv)
+        effecten = sum(p["total_cost"] for p in positions[date(year, 12, 31)].values())
+        balans = _balans(effecten, cash, gestort_kapitaal, wv)
+        reports.append(_store_report(
+            db, bv_id, year, balans, wv, vpb_amount,
+            existing_reports.get(year), existing_filings.get(year), fingerprints[year],
+        ))
+
+    db.commit()
+    return reports
+
+
+def report_fingerprint(db: Session, bv_id: int, year: int) -> str:
+    """Hash of everything the year's report is computed from.
+
+    - the BV's rollup rows up to the year (counts, amounts and realized gain
+      adjustments, so any new, back-dated or reprocessed transaction);
+    - the latest holdings checkpoint on or before year end, plus the count
+      and max id of the processed buys and sells after it (the year-end
+      positions);
+    - the cost method and REPORT_VERSION.
+
+    A few small indexed queries, independent of the ledger's size once the
+    BV has checkpoints.
+    """
+    end = date(year, 12, 31)
+    r = TransactionRollup
+    rollups = db.execute(
+        select(r.year, r.month, r.type, r.tx_count, cast(r.amount, BigInteger),
+               cast(r.abs_amount, BigInteger), cast(r.gain_adjustment, BigInteger))
+        .where(r.bv_id == bv_id, r.year <= year)
+        .order_by(r.year, r.month, r.type)
+    ).all()
+    checkpoint = db.execute(
+        select(HoldingCheckpoint.id, HoldingCheckpoint.as_of, HoldingCheckpoint.created_at)
+        .where(HoldingCheckpoint.bv_id == bv_id, HoldingCheckpoint.as_of <= end)
+        .order_by(HoldingCheckpoint.as_of.desc())
+        .limit(1)
+    ).first()
+    trades = select(func.count(Transaction.id), func.max(Transaction.id)).where(
+        Transaction.bv_id == bv_id,
+        Transaction.processed == True,  # noqa: E712
+        Transaction.type.in_(("buy", "sell")),
+        Transaction.date <= end,
     )
+    if checkpoint:
+        trades = trades.where(Transaction.date > checkpoint.as_of)
+    method = db.query(BV.cost_method).filter_by(id=bv_id).scalar()
 
-    # Calculate W&V components
-    wv = _calculate_winst_verlies(txs)
+    inputs = (
+        REPORT_VERSION,
+        [tuple(row) for row in rollups],
+        tuple(checkpoint) if checkpoint else None,
+        tuple(db.execute(trades).one()),
+        method,
+    )
+    return hashlib.sha1(repr(inputs).encode()).hexdigest()
 
-    # Calculate VPB
-    from services.vpb import calculate_vpb
-    vpb_amount = calculate_vpb(wv["resultaat_voor_belasting"])
 
-    wv["vpb"] = round(vpb_amount, 2)
-    wv["resultaat_na_belasting"] = round(wv["resultaat_voor_belasting"] - vpb_amount, 2)
+def _up_to_date(report: AnnualReport | None, vpb_filing: VPBFiling | None, fingerprint: str) -> bool:
+    return bool(report and vpb_filing and report.fingerprint == fingerprint)
 
-    # Build balans
-    balans = _calculate_balans(db, bv_id, year, wv)
 
-    # Check if report already exists
-    report = db.query(AnnualReport).filter_by(bv_id=bv_id, year=year).first()
+def _store_report(db: Session, bv_id: int, year: int, balans: dict, wv: dict, vpb_amount: float,
+                  report: AnnualReport | None, vpb_filing: VPBFiling | None,
+                  fingerprint: str) -> AnnualReport:
+    """Update the year's existing report and filing (None if missing) or add them; the caller commits."""
     if report:
         report.balans = balans
         report.winst_verlies = wv
         report.generated_at = datetime.utcnow()
         report.status = "draft"
+        report.fingerprint = fingerprint
     else:
         report = AnnualReport(
             bv_id=bv_id,
@@ -48,11 +157,11 @@ def generate_annual_report(db: Session, bv_id: int, year: int) -> AnnualReport:
             winst_verlies=wv,
             status="draft",
             generated_at=datetime.utcnow(),
+            fingerprint=fingerprint,
         )
         db.add(report)
 
     # Upsert VPB filing
-    vpb_filing = db.query(VPBFiling).filter_by(bv_id=bv_id, year=year).first()
     if vpb_filing:
         vpb_filing.taxable_profit = wv["resultaat_voor_belasting"]
         vpb_filing.vpb_amount = vpb_amount
@@ -65,39 +174,58 @@ def generate_annual_report(db: Session, bv_id: int, year: int) -> AnnualReport:
             status="draft",
         )
         db.add(vpb_filing)
-
-    db.commit()
     return report
 
 
-def _calculate_winst_verlies(txs: list) -> dict:
-    """Calculate profit & loss from transactions."""
-    realized_gains = 0.0
-    dividends = 0.0
-    interest = 0.0
-    transaction_costs = 0.0
-    other_costs = 0.0
-
-    for tx in txs:
-        if tx.type == "sell":
-            # For sells, the gain is embedded in the amount vs cost basis
-            # We track the sell proceeds; the engine already calculated gains
-            # But here we approximate from transaction data
-            realized_gains += tx.amount  # proceeds (could be positive or negative net)
-        elif tx.type == "buy":
-            # Buys reduce cash but don't affect P&L
-            pass
-        elif tx.type == "dividend":
-            dividends += abs(tx.amount)
-        elif tx.type == "interest":
-            interest += abs(tx.amount)
-        elif tx.type == "cost":
-            transaction_costs += abs(tx.amount)
-        elif tx.type in ("deposit", "withdrawal"):
-            pass  # Capital movements, not P&L
-
-    # For a more accurate calc, we'd track cost basis per sell
-    # For MVP, we use the sell amount directly (which in seed data = proceeds - cost = gain)
+def _year_totals(db: Session, bv_id: int, year: int) -> tuple[dict, float, float]:
+    """Unrounded W&V components, liquide middelen and gestort kapitaal for a year.
+
+    Read from the BV's columnar ledger (services/ledger_cache.py), which is
+    loaded from its transaction rollups, so no transaction rows are scanned.
+    """
+    from services.ledger_cache import get_ledger
+    return _figures(get_ledger(db, bv_id), year)
+
+
+def _figures(ledger, year: int) -> tuple[dict, float, float]:
+    """W&V components, cash and gestort kapitaal for a year from a columnar ledger."""
+    start, end = date(year, 1, 1), date(year, 12, 31)
+
+    # Buys and capital movements don't affect P&L
+    components = {
+        "realized_gains": ledger.realized_gains(start, end),
+        "dividends": ledger.total("dividend", start, end),
+        "interest": ledger.total("interest", start, end),
+        "transaction_costs": ledger.total("cost", start, end),
+    }
+
+    def total(tx_type):
+        return ledger.total(tx_type, end=end)
+
+    # Gestort kapitaal = sum of deposits - withdrawals (equity contributions)
+    gestort_kapitaal = total("deposit") - total("withdrawal")
+
+    # Cash: deposits - withdrawals + dividends + interest + sell proceeds - buy costs - fees
+    cash = (
+        gestort_kapitaal
+        + total("sell") + total("dividend") + total("interest")
+        - total("buy") - total("cost")
+    )
+    return components, cash, gestort_kapitaal
+
+
+def _add_vpb(wv: dict) -> float:
+    """Add vpb and resultaat_na_belasting to a W&V; returns the unrounded VPB."""
+    from services.vpb import calculate_vpb
+    vpb_amount = calculate_vpb(wv["resultaat_voor_belasting"])
+
+    wv["vpb"] = round(vpb_amount, 2)
+    wv["resultaat_na_belasting"] = round(wv["resultaat_voor_belasting"] - vpb_amount, 2)
+    return vpb_amount
+
+
+def _winst_verlies(realized_gains: float, dividends: float, interest: float,
+                   transaction_costs: float, other_costs: float = 0.0) -> dict:
     resultaat = realized_gains + dividends + interest - transaction_costs - other_costs
 
     return {
@@ -110,50 +238,22 @@ def _calculate_winst_verlies(txs: list) -> dict:
     }
 
 
-def _calculate_balans(db: Session, bv_id: int, year: int, wv: dict) -> dict:
+def _calculate_balans(db: Session, bv_id: int, year: int, wv: dict,
+                      cash: float, gestort_kapitaal: float) -> dict:
     """Calculate balance sheet as of 31-12-YEAR."""
 
-    # Holdings at cost price
-    holdings = db.query(Holding).filter_by(bv_id=bv_id).all()
-    effecten = sum(h.total_cost for h in holdings)
+    # Holdings at cost price, as they were at year end
+    from services.transaction_engine import holdings_as_of
+    positions = holdings_as_of(db, bv_id, date(year, 12, 31))
+    effecten = sum(p["total_cost"] for p in positions.values())
 
-    # Cash: sum of all deposits - withdrawals + dividends + interest + sell proceeds - buy costs - fees
-    all_txs = (
-        db.query(Transaction)
-        .filter(
-            Transaction.bv_id == bv_id,
-            extract("year", Transaction.date) <= year,
-        )
-        .all()
-    )
+    return _balans(effecten, cash, gestort_kapitaal, wv)
 
-    cash = 0.0
-    for tx in all_txs:
-        if tx.type == "deposit":
-            cash += abs(tx.amount)
-        elif tx.type == "withdrawal":
-            cash -= abs(tx.amount)
-        elif tx.type == "buy":
-            cash -= abs(tx.amount)
-        elif tx.type == "sell":
-            cash += abs(tx.amount)
-        elif tx.type == "dividend":
-            cash += abs(tx.amount)
-        elif tx.type == "interest":
-            cash += abs(tx.amount)
-        elif tx.type == "cost":
-            cash -= abs(tx.amount)
 
+def _balans(effecten: float, cash: float, gestort_kapitaal: float, wv: dict) -> dict:
+    """Balance sheet from its building blocks; winstreserve is the balancing item."""
     totaal_activa = effecten + cash
 
-    # Passiva
-    # Gestort kapitaal = sum of deposits - withdrawals (equity contributions)
-    gestort_kapitaal = sum(
-        abs(tx.amount) for tx in all_txs if tx.type == "deposit"
-    ) - sum(
-        abs(tx.amount) for tx in all_txs if tx.type == "withdrawal"
-    )
-
     # Prior year retained earnings (simplified: total P&L minus current year)
     # For MVP, we calculate current year result from wv
     resultaat_boekjaar = wv["resultaat_na_belasting"]
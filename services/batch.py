@@ -0,0 +1,127 @@
+"""Batch processing across BVs: process transactions and regenerate annual reports.
+
+Each BV is handled in its own worker process with its own session, so one
+failing BV does not affect the others. BVs are locked while they are
+processed (services/locks.py), so the batch can run next to the web app.
+
+Usage: python -m services.batch [--year 2025 ...] [--workers N] [--bv ID ...] [--no-report]
+"""
+
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from typing import Callable, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import config
+
+_Session = None
+
+
+def run_batch(database_url: str, bv_ids: list[int], years: Optional[list[int]] = None,
+              workers: int = config.BATCH_WORKERS,
+              on_result: Optional[Callable[[dict], None]] = None) -> dict:
+    """Run process_transactions (and generate the annual reports of `years`) per BV.
+
+    BVs are spread over a pool of `workers` processes. `on_result` is called
+    in the parent with each BV's result as soon as it finishes.
+
+    Returns summary: {bvs: int, failed: int, transactions: int, seconds: float,
+    bvs_per_sec: float, tx_per_sec: float, results: [dict]}
+    """
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(database_url,)) as pool:
+        futures = [pool.submit(process_bv, bv_id, years) for bv_id in bv_ids]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if on_result:
+                on_result(result)
+    seconds = time.perf_counter() - start
+
+    transactions = sum(r["processed"] for r in results)
+    return {
+        "bvs": len(results),
+        "failed": sum(1 for r in results if r["error"]),
+        "transactions": transactions,
+        "seconds": round(seconds, 3),
+        "bvs_per_sec": round(len(results) / seconds, 1) if seconds else 0,
+        "tx_per_sec": round(transactions / seconds, 1) if seconds else 0,
+        "results": sorted(results, key=lambda r: r["bv_id"]),
+    }
+
+
+def process_bv(bv_id: int, years: Optional[list[int]] = None) -> dict:
+    """Worker: process one BV's transactions and regenerate its reports.
+
+    Several years are generated in one pass (generate_annual_reports).
+    Errors are caught and returned so the pool keeps going.
+    """
+    from services.annual_report import generate_annual_reports
+    from services.locks import bv_lock
+    from services.transaction_engine import process_transactions
+
+    start = time.perf_counter()
+    result = {"bv_id": bv_id, "processed": 0, "errors": [], "report": False, "error": None}
+    db = _Session()
+    try:
+        with bv_lock(db, bv_id):
+            summary = process_transactions(db, bv_id)
+            result["processed"] = summary["processed"]
+            result["errors"] = summary["errors"]
+            if years:
+                generate_annual_reports(db, bv_id, years)
+                result["report"] = True
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        db.close()
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def _init_worker(database_url: str):
+    """Give each worker process its own engine and connection pool."""
+    global _Session
+    _Session = sessionmaker(bind=create_engine(database_url))
+
+
+if __name__ == "__main__":
+    from models import BV, init_db
+
+    parser = argparse.ArgumentParser(description="Process transactions and annual reports for many BVs.")
+    parser.add_argument("--year", type=int, action="append",
+                        help="report year, repeat for several (default: last year)")
+    parser.add_argument("--no-report", action="store_true", help="only process transactions")
+    parser.add_argument("--workers", type=int, default=config.BATCH_WORKERS)
+    parser.add_argument("--bv", type=int, action="append", help="limit to these BV ids")
+    parser.add_argument("--db", default=config.DATABASE_URL)
+    args = parser.parse_args()
+
+    # Create/migrate the schema once, before the workers start
+    _, Session = init_db(args.db)
+    db = Session()
+    try:
+        bv_ids = args.bv or [bv_id for (bv_id,) in db.query(BV.id).order_by(BV.id)]
+    finally:
+        db.close()
+
+    done = 0
+
+    def progress(result):
+        global done
+        done += 1
+        status = f"FOUT: {result['error']}" if result["error"] else f"{result['processed']} tx"
+        print(f"[{done}/{len(bv_ids)}] BV {result['bv_id']}: {status} ({result['seconds']:.2f}s)", flush=True)
+
+    years = args.year or [date.today().year - 1]
+    summary = run_batch(args.db, bv_ids, None if args.no_report else years, args.workers, progress)
+    print(
+        f"{summary['bvs']} BVs ({summary['failed']} mislukt), {summary['transactions']} transacties "
+        f"in {summary['seconds']:.1f}s: {summary['bvs_per_sec']} BVs/s, {summary['tx_per_sec']} tx/s"
+    )
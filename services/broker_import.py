@@ -3,17 +3,41 @@
 import csv
 import io
 from datetime import datetime
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator
+
+# Rows per classify/persist batch when streaming an upload
+IMPORT_BATCH_SIZE = 500
+
+
+def open_csv_stream(stream: BinaryIO) -> io.TextIOWrapper:
+    """Wrap a binary upload stream for line-by-line CSV reading.
+
+    Decodes lazily (BOM-aware), so the file is never held in memory as a whole.
+    """
+    return io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+
+
+def batched(items: Iterable[dict], size: int) -> Iterator[list[dict]]:
+    """Yield lists of at most `size` items from an iterable."""
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
 
 
 def parse_degiro_csv(file_content: str) -> list[dict]:
-    """Parse DEGIRO CSV export.
+    """Parse DEGIRO CSV export held in memory. See iter_degiro_csv."""
+    return list(iter_degiro_csv(io.StringIO(file_content)))
+
+
+def iter_degiro_csv(lines: Iterable[str]) -> Iterator[dict]:
+    """Stream a DEGIRO CSV export, yielding one normalized transaction per row.
 
     Expected columns: Datum, Tijd, Product, ISIN, Beurs, Uitvoeringsplaats,
     Aantal, Koers, Waarde lokale valuta, Waarde, Wisselkoers, Transactiekosten en/of,
     Totaal, Order Id
     """
-    reader = csv.DictReader(io.StringIO(file_content))
-    transactions = []
+    reader = csv.DictReader(lines)
 
     for row in reader:
         # Skip empty rows
@@ -56,7 +80,7 @@ def parse_degiro_csv(file_content: str) -> list[dict]:
         exchange = row.get("Beurs", "").strip()
         ticker = _isin_to_ticker(isin, exchange) if isin else None
 
-        transactions.append({
+        yield {
             "date": tx_date,
             "type": tx_type,
             "ticker": ticker,
@@ -66,91 +90,158 @@ def parse_degiro_csv(file_content: str) -> list[dict]:
             "amount": total if total else 0,
             "currency": "EUR",
             "broker_ref": row.get("Order Id", "").strip(),
-        })
-
-    return transactions
+        }
 
 
 def parse_ib_csv(file_content: str) -> list[dict]:
-    """Parse Interactive Brokers CSV export (Trades section).
+    """Parse Interactive Brokers CSV export held in memory. See iter_ib_csv."""
+    return list(iter_ib_csv(io.StringIO(file_content)))
 
-    IB exports are more complex with multiple sections.
-    We focus on the Trades section.
+
+def iter_ib_csv(lines: Iterable[str]) -> Iterator[dict]:
+    """Stream an Interactive Brokers activity statement in a single pass.
+
+    IB exports are one CSV with many sections; every row starts with the
+    section name and a row kind (Header / Data / Total / ...). Header rows set
+    the columns for their section, Data rows are dispatched to the section's
+    handler in IB_SECTION_HANDLERS. Sections without a handler are skipped.
     """
-    reader = csv.reader(io.StringIO(file_content))
-    transactions = []
-    in_trades = False
-    headers = []
+    reader = csv.reader(lines)
+    headers = {}
 
     for row in reader:
-        if not row:
+        if len(row) < 2:
             continue
 
-        # Find the Trades section
-        if row[0] == "Trades" and row[1] == "Header":
-            headers = row[2:]
-            in_trades = True
+        section, kind = row[0], row[1]
+        if kind == "Header":
+            headers[section] = row[2:]
             continue
-        elif row[0] == "Trades" and row[1] == "Data" and in_trades:
-            data = dict(zip(headers, row[2:]))
-
-            try:
-                tx_date = datetime.strptime(data.get("Date/Time", "").split(",")[0].strip(), "%Y-%m-%d").date()
-            except (ValueError, KeyError):
-                continue
-
-            quantity = float(data.get("Quantity", 0))
-            price = float(data.get("T. Price", 0))
-            proceeds = float(data.get("Proceeds", 0))
-            commission = float(data.get("Comm/Fee", 0))
-
-            tx_type = "buy" if quantity > 0 else "sell"
-
-            transactions.append({
-                "date": tx_date,
-                "type": tx_type,
-                "ticker": data.get("Symbol", ""),
-                "description": data.get("Symbol", "") + " " + data.get("Date/Time", ""),
-                "quantity": abs(quantity),
-                "price": price,
-                "amount": proceeds + commission,
-                "currency": data.get("Currency", "EUR"),
-                "broker_ref": data.get("Code", ""),
-            })
-        elif row[0] != "Trades" and in_trades:
-            in_trades = False
-
-    return transactions
 
+        handler = IB_SECTION_HANDLERS.get(section)
+        if kind != "Data" or not handler or section not in headers:
+            continue
 
-def _isin_to_ticker(isin: str, exchange: str) -> str:
-    """Best-effort ISIN to ticker mapping.
+        tx = handler(dict(zip(headers[section], row[2:])))
+        if tx:
+            yield tx
 
-    For a real product you'd use a lookup table or API.
-    This handles common ETFs that DEGIRO users trade.
-    """
-    common = {
-        "IE00B4L5Y983": "IWDA",
-        "IE00B3RBWM25": "VWRL",
-        "IE00BK5BQT80": "VWCE",
-        "IE00BKM4GZ66": "EMIM",
-        "LU0392494562": "DBXW",
-        "IE00B0M62Q58": "IUSQ",
-        "NL0000009165": "HEIA",
-        "NL0010273215": "ASML",
-        "NL0000235190": "AIR",
-        "US0378331005": "AAPL",
-        "US5949181045": "MSFT",
+
+def _ib_num(val: str) -> float:
+    """IB numbers use '.' decimals and may contain ',' thousands separators."""
+    val = (val or "").strip().replace(",", "")
+    return float(val) if val and val != "--" else 0.0
+
+
+def _ib_date(val: str):
+    """IB dates are YYYY-MM-DD, optionally followed by ', HH:MM:SS'."""
+    try:
+        return datetime.strptime((val or "").split(",")[0].strip(), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _ib_trade(data: dict) -> dict | None:
+    # Trades also carries per-lot and subtotal rows; only orders are transactions
+    if data.get("DataDiscriminator", "Order") not in ("Order", "Trade"):
+        return None
+
+    tx_date = _ib_date(data.get("Date/Time", ""))
+    if not tx_date:
+        return None
+
+    quantity = _ib_num(data.get("Quantity"))
+    price = _ib_num(data.get("T. Price"))
+    proceeds = _ib_num(data.get("Proceeds"))
+    commission = _ib_num(data.get("Comm/Fee"))
+
+    tx_type = "buy" if quantity > 0 else "sell"
+
+    return {
+        "date": tx_date,
+        "type": tx_type,
+        "ticker": data.get("Symbol", ""),
+        "description": data.get("Symbol", "") + " " + data.get("Date/Time", ""),
+        "quantity": abs(quantity),
+        "price": price,
+        "amount": proceeds + commission,
+        "currency": data.get("Currency", "EUR"),
+        "broker_ref": data.get("Code", ""),
     }
 
-    suffix_map = {
-        "XET": ".DE",
-        "EPA": ".PA",
-        "AMS": ".AS",
-        "LSE": ".L",
-        "EAM": ".AS",
+
+def _ib_cash(data: dict, tx_type: str, date_field: str = "Date") -> dict | None:
+    """Shared shape of IB cash sections: Currency, Date, Description, Amount."""
+    # Per-currency and grand totals are reported as Data rows too
+    if data.get("Currency", "").startswith("Total"):
+        return None
+
+    tx_date = _ib_date(data.get(date_field, ""))
+    if not tx_date:
+        return None
+
+    description = data.get("Description", "").strip()
+    # Dividend/withholding descriptions look like "AAPL(US0378331005) Cash Dividend ..."
+    ticker = description.split("(")[0].strip() if "(" in description else None
+
+    return {
+        "date": tx_date,
+        "type": tx_type,
+        "ticker": ticker,
+        "description": description or f"IB {tx_type}",
+        "quantity": None,
+        "price": None,
+        "amount": _ib_num(data.get("Amount")),
+        "currency": data.get("Currency", "EUR"),
+        "broker_ref": data.get("Code", ""),
     }
 
-    ticker = common.get(isin, isin[:6])
-    suffix = suffix_map.get(exchange, "")
+
+def _ib_interest(data: dict) -> dict | None:
+    tx = _ib_cash(data, "interest")
+    # Debit interest is a cost, not income
+    if tx and tx["amount"] < 0:
+        tx["type"] = "cost"
+    return tx
+
+
+def _ib_deposit(data: dict) -> dict | None:
+    tx = _ib_cash(data, "deposit", date_field="Settle Date")
+    if tx and tx["amount"] < 0:
+        tx["type"] = "withdrawal"
+    return tx
+
+
+IB_SECTION_HANDLERS = {
+    "Trades": _ib_trade,
+    "Dividends": lambda data: _ib_cash(data, "dividend"),
+    "Withholding Tax": lambda data: _ib_cash(data, "cost"),
+    "Interest": _ib_interest,
+    "Fees": lambda data: _ib_cash(data, "cost"),
+    "Deposits & Withdrawals": _ib_deposit,
+}
+
+
+# DEGIRO exchange codes → ticker suffix
+EXCHANGE_SUFFIXES = {
+    "XET": ".DE",
+    "EPA": ".PA",
+    "AMS": ".AS",
+    "LSE": ".L",
+    "EAM": ".AS",
+}
+
+
+def _isin_to_ticker(isin: str, exchange: str) -> str:
+    """Map an ISIN to a ticker via the instrument master (services/instruments.py).
+
+    The suffix comes from the row's exchange code; rows without a known
+    exchange get the bare ticker. Unknown ISINs keep the full ISIN as ticker
+    so they never collide with other instruments.
+    """
+    from services.instruments import lookup
+
+    known = lookup(isin)
+    ticker = known[0] if known else isin
+    suffix = EXCHANGE_SUFFIXES.get(exchange, "")
     return ticker + suffix
@@ -0,0 +1,185 @@
+"""Streaming import pipeline: parse → classify → persist broker uploads."""
+
+import hashlib
+from collections import Counter
+from typing import BinaryIO, Callable, Optional
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from models import Transaction, ImportedFile
+from services.broker_import import (
+    IMPORT_BATCH_SIZE,
+    batched,
+    iter_degiro_csv,
+    iter_ib_csv,
+    open_csv_stream,
+)
+
+
+def import_stream(db: Session, bv_id: int, stream: BinaryIO, broker_type: str = "degiro",
+                  batch_size: int = IMPORT_BATCH_SIZE,
+                  on_batch: Optional[Callable[[dict], None]] = None) -> dict:
+    """Import a broker CSV upload for a BV in fixed-size batches.
+
+    Rows are parsed lazily from the stream, classified and bulk-inserted one batch at
+    a time, so memory use does not grow with file size. The caller commits.
+    Only rows the parser could not type ("other") are sent to the classifier.
+
+    Re-imports are idempotent: a file whose hash was imported before is
+    rejected before parsing (duplicate=True), and rows whose fingerprint
+    already exists for the BV are skipped.
+
+    `on_batch` is called with the running summary after every batch, e.g. to
+    report progress.
+
+    Returns summary: {parsed: int, classified: int, skipped: int, inserted: int,
+    batches: int, duplicate: bool}
+    """
+    from services.ai_classifier import classify_transactions
+
+    summary = {"parsed": 0, "classified": 0, "skipped": 0, "inserted": 0, "batches": 0,
+               "duplicate": False}
+
+    file_hash = _hash_stream(stream)
+    if file_already_imported(db, bv_id, file_hash):
+        summary["duplicate"] = True
+        return summary
+
+    text = open_csv_stream(stream)
+    rows = iter_ib_csv(text) if broker_type == "ib" else iter_degiro_csv(text)
+
+    try:
+        for batch in batched(_fingerprinted(rows), batch_size):
+            fresh = _drop_known(db, bv_id, batch)
+            summary["parsed"] += len(batch)
+            summary["skipped"] += len(batch) - len(fresh)
+            if fresh:
+                # Types the parser derived (IB sections, trade shape) are final;
+                # only rows it could not type go through the classifier
+                untyped = [tx for tx in fresh if tx.get("type") in (None, "other")]
+                if untyped:
+                    classify_transactions(untyped, db, broker_type)
+                summary["classified"] += len(untyped)
+                summary["inserted"] += len(bulk_insert_transactions(db, bv_id, fresh))
+            summary["batches"] += 1
+            if on_batch:
+                on_batch(summary)
+    finally:
+        # Leave the underlying upload stream open for the caller
+        text.detach()
+
+    db.add(ImportedFile(bv_id=bv_id, sha256=file_hash, broker=broker_type, rows=summary["parsed"]))
+    db.flush()
+    return summary
+
+
+def file_already_imported(db: Session, bv_id: int, file_hash: str) -> bool:
+    """True if a file with this SHA-256 was imported for the BV before."""
+    return db.execute(
+        select(ImportedFile.id).where(ImportedFile.bv_id == bv_id, ImportedFile.sha256 == file_hash)
+    ).first() is not None
+
+
+def bulk_insert_transactions(db: Session, bv_id: int, parsed: list[dict]) -> list[int]:
+    """Insert parsed transactions with one executemany INSERT.
+
+    Bypasses per-object unit-of-work bookkeeping. The BV's rollups are
+    updated in the same transaction. Returns the new transaction ids in
+    input order, for the process_transactions step.
+    """
+    from services.rollups import record_transactions
+
+    if not parsed:
+        return []
+
+    rows = [_transaction_row(bv_id, tx_data) for tx_data in parsed]
+    result = db.execute(
+        insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True),
+        rows,
+    )
+    ids = list(result.scalars())
+    record_transactions(db, bv_id, rows)
+    return ids
+
+
+def transaction_fingerprint(tx_data: dict, occurrence: int = 0) -> str:
+    """Stable dedup key for a parsed transaction within a BV.
+
+    Built from broker_ref, date, amount, currency, ticker and description;
+    the description tells apart equal amounts from different statement
+    sections (a fee and debit interest on one day). `occurrence` numbers
+    otherwise identical rows in the same file, so genuine repeats (two equal
+    fees on one day) survive while a re-upload maps onto the same keys.
+    Every part is stored on the transaction, see models._refingerprint.
+    """
+    key = "|".join([
+        tx_data.get("broker_ref") or "",
+        tx_data["date"].isoformat(),
+        f"{tx_data['amount']:.2f}",
+        tx_data.get("currency") or "EUR",
+        tx_data.get("ticker") or "",
+        tx_data.get("description") or "",
+        str(occurrence),
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _fingerprinted(rows):
+    """Attach a fingerprint to each parsed row.
+
+    Occurrences are counted per key over the whole file: IB statements list
+    rows by section and currency, so one day's rows are not contiguous.
+    """
+    counts = Counter()
+    for tx_data in rows:
+        base = transaction_fingerprint(tx_data)
+        tx_data["fingerprint"] = transaction_fingerprint(tx_data, counts[base])
+        counts[base] += 1
+        yield tx_data
+
+
+def _drop_known(db: Session, bv_id: int, batch: list[dict]) -> list[dict]:
+    """Remove rows whose fingerprint is already stored for this BV or repeats in the batch.
+
+    One indexed lookup per batch via ix_transactions_bv_fingerprint.
+    """
+    fingerprints = [tx_data["fingerprint"] for tx_data in batch]
+    known = set(db.execute(
+        select(Transaction.fingerprint).where(
+            Transaction.bv_id == bv_id,
+            Transaction.fingerprint.in_(fingerprints),
+        )
+    ).scalars())
+    fresh = []
+    for tx_data in batch:
+        if tx_data["fingerprint"] not in known:
+            known.add(tx_data["fingerprint"])
+            fresh.append(tx_data)
+    return fresh
+
+
+def _hash_stream(stream: BinaryIO) -> str:
+    """SHA-256 of a seekable binary stream, read in chunks. Rewinds afterwards."""
+    digest = hashlib.sha256()
+    while chunk := stream.read(1 << 16):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def _transaction_row(bv_id: int, tx_data: dict) -> dict:
+    return {
+        "bv_id": bv_id,
+        "date": tx_data["date"],
+        "type": tx_data.get("type", "other"),
+        "ticker": tx_data.get("ticker"),
+        "description": tx_data["description"],
+        "quantity": tx_data.get("quantity"),
+        "price": tx_data.get("price"),
+        "amount": tx_data["amount"],
+        "currency": tx_data.get("currency", "EUR"),
+        "broker_ref": tx_data.get("broker_ref", ""),
+        "category": tx_data.get("type"),
+        "category_source": tx_data.get("type_source", "parser"),
+        "processed": False,
+        "fingerprint": tx_data.get("fingerprint"),
+    }
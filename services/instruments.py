@@ -0,0 +1,103 @@
+"""Instrument master: ISIN → ticker index backed by the instruments table."""
+
+import csv
+import os
+import sys
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from models import Instrument
+
+# Default instrument list shipped with the app; refresh with a larger export
+INSTRUMENTS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instruments.csv")
+
+# isin -> (ticker, exchange_suffix); replaced wholesale on (re)load
+_index: dict[str, tuple[str, str]] | None = None
+
+
+def lookup(isin: str) -> tuple[str, str] | None:
+    """Return (ticker, exchange_suffix) for an ISIN, or None if unknown.
+
+    Served from the in-process index. Before load_instruments() has run
+    (e.g. parsing outside the app) the bundled CSV is used.
+    """
+    global _index
+    if _index is None:
+        _index = {row["isin"]: (row["ticker"], row["exchange_suffix"]) for row in _read_csv(INSTRUMENTS_CSV)}
+    return _index.get(isin)
+
+
+def load_instruments(db: Session) -> int:
+    """Load the instruments table into the in-process index.
+
+    Seeds the table from the bundled CSV on first run. Returns the index size.
+    """
+    global _index
+    if not db.query(Instrument.id).first():
+        refresh_instruments(db, INSTRUMENTS_CSV)
+
+    rows = db.query(Instrument.isin, Instrument.ticker, Instrument.exchange_suffix).all()
+    _index = {isin: (ticker, suffix or "") for isin, ticker, suffix in rows}
+    return len(_index)
+
+
+def refresh_instruments(db: Session, path: str) -> dict:
+    """Bulk upsert instruments from a CSV (isin,ticker,exchange_suffix,name,currency).
+
+    Returns summary: {inserted: int, updated: int}
+    """
+    global _index
+    existing = {i.isin: i for i in db.query(Instrument).all()}
+    new_rows = []
+    seen = set()
+    updated = 0
+
+    for row in _read_csv(path):
+        instrument = existing.get(row["isin"])
+        if instrument:
+            changed = False
+            for field in ("ticker", "exchange_suffix", "name", "currency"):
+                if getattr(instrument, field) != row[field]:
+                    setattr(instrument, field, row[field])
+                    changed = True
+            updated += changed
+        elif row["isin"] not in seen:
+            new_rows.append(row)
+        seen.add(row["isin"])
+
+    if new_rows:
+        db.execute(insert(Instrument), new_rows)
+    db.commit()
+
+    # Force the next lookup() to see the refreshed table
+    _index = None
+    load_instruments(db)
+    return {"inserted": len(new_rows), "updated": updated}
+
+
+def _read_csv(path: str) -> list[dict]:
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return [
+            {
+                "isin": row["isin"].strip().upper(),
+                "ticker": row["ticker"].strip(),
+                "exchange_suffix": (row.get("exchange_suffix") or "").strip(),
+                "name": (row.get("name") or "").strip(),
+                "currency": (row.get("currency") or "EUR").strip(),
+            }
+            for row in csv.DictReader(f)
+            if row.get("isin") and row.get("ticker")
+        ]
+
+
+if __name__ == "__main__":
+    # Usage: python -m services.instruments [path/to/instruments.csv]
+    import config
+    from models import init_db
+
+    _, Session = init_db(config.DATABASE_URL)
+    db = Session()
+    try:
+        summary = refresh_instruments(db, sys.argv[1] if len(sys.argv) > 1 else INSTRUMENTS_CSV)
+        print(f"Instruments: {summary['inserted']} inserted, {summary['updated']} updated")
+    finally:
+        db.close()
@@ -0,0 +1,245 @@
+"""Background import jobs: a local worker pool backed by the import_jobs table."""
+
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import BinaryIO, Optional
+from sqlalchemy import delete, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+
+import config
+from models import BVLock, ImportJob
+
+_executor = None
+_session_factory = None
+_running = set()  # ids of the jobs this process is running
+
+
+def start_worker_pool(session_factory: sessionmaker, workers: int = config.IMPORT_WORKERS):
+    """Start the in-process worker pool and pick up jobs left queued by a restart.
+
+    Jobs left running by a worker process that is gone are recovered first
+    (see recover_orphaned_jobs), and again every quarter IMPORT_JOB_TTL by
+    a watcher thread that also keeps this process's running jobs alive.
+    """
+    global _executor, _session_factory
+    if _executor:
+        return
+    _session_factory = session_factory
+    _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="import")
+    os.makedirs(config.UPLOAD_DIR, exist_ok=True)
+
+    db = session_factory()
+    try:
+        recover_orphaned_jobs(db)
+        queued = db.query(ImportJob.id).filter_by(status="queued").order_by(ImportJob.id).all()
+    finally:
+        db.close()
+    for (job_id,) in queued:
+        _executor.submit(run_import_job, job_id)
+
+    threading.Thread(target=_watch_jobs, name="import-watcher", daemon=True).start()
+
+
+def recover_orphaned_jobs(db: Session) -> list[int]:
+    """Re-queue running jobs whose worker process is gone and drop its BV locks.
+
+    A worker is gone when its job's heartbeat is older than IMPORT_JOB_TTL,
+    e.g. after a deploy replaced its container. On this host that is known
+    sooner: its pid no longer exists, or it is this process and the job is
+    not one of ours (a restart that reused the pid). Jobs whose spooled
+    file is missing are failed instead. Re-running is safe: batches are
+    idempotent and processing continues where it stopped. Returns the ids
+    of the re-queued jobs.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=config.IMPORT_JOB_TTL)
+    requeued = []
+    for job in db.query(ImportJob).filter_by(status="running").all():
+        if not _worker_gone(job, stale_before):
+            continue
+        if job.worker:
+            db.execute(delete(BVLock).where(BVLock.owner.startswith(f"{job.worker}:")))
+        retry = os.path.exists(job.file_path)
+        values = (
+            {"status": "queued", "started_at": None, "worker": None, "heartbeat_at": None}
+            if retry
+            else {"status": "failed", "error": "Import onderbroken en het bestand is niet meer beschikbaar",
+                  "finished_at": datetime.utcnow()}
+        )
+        # Guarded on the old state, so only one process recovers a job
+        recovered = db.execute(
+            update(ImportJob)
+            .where(ImportJob.id == job.id, ImportJob.status == "running", ImportJob.worker == job.worker)
+            .values(**values)
+        ).rowcount
+        if recovered and retry:
+            requeued.append(job.id)
+    db.commit()
+    return requeued
+
+
+def _watch_jobs():
+    """Every quarter IMPORT_JOB_TTL: beat for our running jobs, recover other workers' stale ones."""
+    while True:
+        time.sleep(config.IMPORT_JOB_TTL / 4)
+        db = _session_factory()
+        try:
+            if _running:
+                db.execute(
+                    update(ImportJob)
+                    .where(ImportJob.id.in_(list(_running)), ImportJob.worker == _worker_id())
+                    .values(heartbeat_at=datetime.utcnow())
+                )
+                db.commit()
+            for job_id in recover_orphaned_jobs(db):
+                _executor.submit(run_import_job, job_id)
+        except OperationalError:
+            # SQLite busy; the next round is still well within the TTL
+            db.rollback()
+        finally:
+            db.close()
+
+
+def _worker_id() -> str:
+    """host:pid of this process; lock owners (services/locks.py) extend it with the thread."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _worker_gone(job: ImportJob, stale_before: datetime) -> bool:
+    if not job.worker:
+        # Claimed before workers were recorded
+        return True
+    if job.worker == _worker_id():
+        return job.id not in _running
+    host, _, pid = job.worker.rpartition(":")
+    if host == socket.gethostname():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    last_seen = job.heartbeat_at or job.started_at
+    return last_seen is None or last_seen < stale_before
+
+
+def enqueue_import(db: Session, bv_id: int, stream: BinaryIO,
+                   broker_type: str = "degiro") -> Optional[ImportJob]:
+    """Spool an upload to disk, persist a job row and hand it to the worker pool.
+
+    Returns None without queueing if the file was imported before.
+    """
+    from services.importer import file_already_imported
+
+    path = os.path.join(config.UPLOAD_DIR, f"{uuid.uuid4().hex}.csv")
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        while chunk := stream.read(1 << 16):
+            digest.update(chunk)
+            f.write(chunk)
+
+    if file_already_imported(db, bv_id, digest.hexdigest()):
+        os.remove(path)
+        return None
+
+    job = ImportJob(bv_id=bv_id, broker=broker_type, file_path=path, status="queued")
+    db.add(job)
+    db.commit()
+
+    _executor.submit(run_import_job, job.id)
+    return job
+
+
+def run_import_job(job_id: int):
+    """Run one import job: parse → classify → persist → process_transactions.
+
+    Progress is committed per import batch and per processing chunk.
+    Batches are idempotent (see services/importer.py), so a failed job can
+    simply be re-submitted. rows_processed counts the rows processed
+    for this import, not older rows a back-dated import made the engine
+    replay.
+    """
+    from services.importer import import_stream
+    from services.locks import bv_lock
+    from services.transaction_engine import process_transactions
+
+    db = _session_factory()
+    try:
+        # Claim the job atomically so two workers never run the same one
+        claimed = db.execute(
+            update(ImportJob)
+            .where(ImportJob.id == job_id, ImportJob.status == "queued")
+            .values(status="running", started_at=datetime.utcnow(), worker=_worker_id(),
+                    heartbeat_at=datetime.utcnow())
+        ).rowcount
+        db.commit()
+        if not claimed:
+            return
+        _running.add(job_id)
+
+        job = db.get(ImportJob, job_id)
+
+        def on_batch(summary):
+            job.rows_parsed = summary["parsed"]
+            job.rows_classified = summary["classified"]
+            job.rows_skipped = summary["skipped"]
+            db.commit()
+
+        def on_progress(summary):
+            # Committed by the engine together with its chunk
+            job.rows_processed = summary["processed"] - summary["replayed"]
+
+        try:
+            # Jobs for the same BV run one after the other
+            with bv_lock(db, job.bv_id):
+                with open(job.file_path, "rb") as f:
+                    result = import_stream(db, job.bv_id, f, job.broker, on_batch=on_batch)
+                db.commit()
+
+                # A recovered job whose file was fully imported before the
+                # restart only needs processing
+                if result["duplicate"] and not job.rows_parsed:
+                    job.status = "failed"
+                    job.error = "Dit bestand is al geïmporteerd"
+                    os.remove(job.file_path)
+                else:
+                    summary = process_transactions(db, job.bv_id, on_progress=on_progress)
+                    job.status = "done"
+                    if summary["errors"]:
+                        job.error = "\n".join(summary["errors"])
+                    os.remove(job.file_path)
+                db.commit()
+        except Exception as e:
+            # Keep the spooled file so the job can be retried
+            db.rollback()
+            job.status = "failed"
+            job.error = str(e)
+
+        job.finished_at = datetime.utcnow()
+        db.commit()
+    finally:
+        _running.discard(job_id)
+        db.close()
+
+
+def job_status(job: ImportJob) -> dict:
+    """JSON-serializable progress for the status endpoint."""
+    return {
+        "id": job.id,
+        "status": job.status,
+        "broker": job.broker,
+        "rows_parsed": job.rows_parsed,
+        "rows_classified": job.rows_classified,
+        "rows_skipped": job.rows_skipped,
+        "rows_processed": job.rows_processed,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
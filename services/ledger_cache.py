@@ -0,0 +1,127 @@
+"""Columnar in-memory copy of a BV's ledger for per-type totals.
+
+Reports and the dashboard only need sums of `amount` per transaction type
+over whole months or years. The ledger is loaded from the BV's transaction
+rollups (services/rollups.py), a few dozen rows, into one column set per
+type (typed `array`s, sorted by month), so a total is a bisect plus a
+C-level sum() over a slice. Amounts are kept as the integer cents stored in
+the database, so totals are exact; they are converted to euros on the way
+out.
+
+Cached per BV and rebuilt when the BV's rollups change (bvs.rollup_version).
+"""
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date
+from typing import Optional
+from sqlalchemy import BigInteger, cast, select
+from sqlalchemy.orm import Session
+
+import config
+from models import BV, TransactionRollup, from_cents
+
+_cache = OrderedDict()  # bv_id -> ColumnarLedger
+_cache_lock = threading.Lock()
+
+
+class _TypeColumns:
+    """Months of one transaction type: month keys, counts and sums in cents."""
+
+    __slots__ = ("months", "counts", "amounts", "abs_amounts", "gain_adjustments")
+
+    def __init__(self):
+        self.months = array("i")  # year * 12 + month - 1
+        self.counts = array("q")
+        self.amounts = array("q")
+        self.abs_amounts = array("q")
+        self.gain_adjustments = array("q")
+
+
+class ColumnarLedger:
+    __slots__ = ("version", "columns", "rows")
+
+    def __init__(self, version):
+        self.version = version
+        self.columns = {}  # type -> _TypeColumns
+        self.rows = 0
+
+    def total(self, tx_type: str, start: Optional[date] = None, end: Optional[date] = None,
+              absolute: bool = True) -> float:
+        """Sum of amounts of `tx_type` in the months from start through end (bounds optional).
+
+        With `absolute` each amount counts as abs(amount), as the reports do.
+        """
+        cols = self.columns.get(tx_type)
+        if not cols:
+            return 0.0
+        lo, hi = self._bounds(cols, start, end)
+        return from_cents(sum((cols.abs_amounts if absolute else cols.amounts)[lo:hi]))
+
+    def realized_gains(self, start: Optional[date] = None, end: Optional[date] = None) -> float:
+        """Realized result of the sells in the date range.
+
+        The gain the engine stored per sell; sells without one (processed
+        before the lot ledger existed, or not yet processed) count at their
+        proceeds as an approximation.
+        """
+        cols = self.columns.get("sell")
+        if not cols:
+            return 0.0
+        lo, hi = self._bounds(cols, start, end)
+        return from_cents(sum(cols.amounts[lo:hi]) + sum(cols.gain_adjustments[lo:hi]))
+
+    @staticmethod
+    def _bounds(cols: _TypeColumns, start: Optional[date], end: Optional[date]) -> tuple[int, int]:
+        lo = bisect_left(cols.months, start.year * 12 + start.month - 1) if start else 0
+        hi = bisect_right(cols.months, end.year * 12 + end.month - 1) if end else len(cols.months)
+        return lo, hi
+
+
+def get_ledger(db: Session, bv_id: int) -> ColumnarLedger:
+    """The BV's columnar ledger, rebuilt if its rollups changed since it was cached.
+
+    Freshness is checked with one primary key lookup (bvs.rollup_version).
+    """
+    version = db.scalar(select(BV.rollup_version).where(BV.id == bv_id))
+
+    with _cache_lock:
+        ledger = _cache.get(bv_id)
+        if ledger and ledger.version == version:
+            _cache.move_to_end(bv_id)
+            return ledger
+
+    ledger = _build(db, bv_id, version)
+    with _cache_lock:
+        _cache[bv_id] = ledger
+        _cache.move_to_end(bv_id)
+        while len(_cache) > config.LEDGER_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return ledger
+
+
+def _build(db: Session, bv_id: int, version) -> ColumnarLedger:
+    ledger = ColumnarLedger(version)
+    r = TransactionRollup
+    rows = db.execute(
+        select(
+            r.type, r.year, r.month, r.tx_count,
+            cast(r.amount, BigInteger), cast(r.abs_amount, BigInteger), cast(r.gain_adjustment, BigInteger),
+        )
+        .where(r.bv_id == bv_id)
+        .order_by(r.type, r.year, r.month)
+    )
+    columns = ledger.columns
+    for tx_type, year, month, count, amount, abs_amount, adjustment in rows:
+        cols = columns.get(tx_type)
+        if cols is None:
+            cols = columns[tx_type] = _TypeColumns()
+        cols.months.append(year * 12 + month - 1)
+        cols.counts.append(count)
+        cols.amounts.append(amount)
+        cols.abs_amounts.append(abs_amount)
+        cols.gain_adjustments.append(adjustment)
+        ledger.rows += count
+    return ledger
@@ -0,0 +1,132 @@
+"""Per-BV locks so imports, processing and reports for one BV never overlap.
+
+A lock is a row in bv_locks, inserted and deleted on its own connection.
+The primary key makes the insert fail while another worker (thread, process
+or host) holds the BV, which works the same on SQLite and Postgres.
+Different BVs never wait for each other.
+
+While a lock is held a heartbeat thread refreshes its acquired_at, so only
+locks whose holder died (no heartbeat for BV_LOCK_TTL) are taken over.
+Request handlers pass timeout=0 and answer 409 instead of waiting.
+"""
+
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session
+
+import config
+from models import BVLock
+
+
+class BVLocked(RuntimeError):
+    """Raised when a BV stays locked for longer than the timeout."""
+
+
+_stats = {"acquired": 0, "contended": 0, "timeouts": 0, "stale_released": 0,
+          "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+@contextmanager
+def bv_lock(db: Session, bv_id: int, timeout: float = config.BV_LOCK_TIMEOUT):
+    """Hold the lock for `bv_id` while the block runs.
+
+    Waits with backoff while another worker holds it and raises BVLocked
+    after `timeout` seconds (at once with timeout=0). Locks not refreshed
+    for BV_LOCK_TTL are assumed abandoned (a crashed worker) and taken over.
+    If the block raises, `db` is rolled back before the lock is released.
+    """
+    engine = db.get_bind()
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    start = time.monotonic()
+    delay = 0.02
+    contended = False
+
+    while not _try_acquire(engine, bv_id, owner):
+        contended = True
+        waited = time.monotonic() - start
+        if waited >= timeout:
+            _record(time.monotonic() - start, contended, timed_out=True)
+            raise BVLocked(f"BV {bv_id} is bezet door een andere verwerking")
+        time.sleep(min(delay, timeout - waited))
+        delay = min(delay * 2, 1.0)
+
+    _record(time.monotonic() - start, contended)
+    stop = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat, args=(engine, bv_id, owner, stop), name=f"bv-lock-{bv_id}", daemon=True
+    )
+    heartbeat.start()
+    try:
+        yield
+    except BaseException:
+        # Drop half-done work while the BV is still ours
+        db.rollback()
+        raise
+    finally:
+        stop.set()
+        heartbeat.join()
+        with engine.begin() as conn:
+            conn.execute(delete(BVLock).where(BVLock.bv_id == bv_id, BVLock.owner == owner))
+
+
+def lock_stats() -> dict:
+    """Process-local lock counters, for /api/admin/stats."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["wait_seconds"] = round(stats["wait_seconds"], 3)
+    stats["max_wait_seconds"] = round(stats["max_wait_seconds"], 3)
+    stats["avg_wait_seconds"] = round(stats["wait_seconds"] / stats["acquired"], 4) if stats["acquired"] else 0.0
+    return stats
+
+
+def _try_acquire(engine, bv_id: int, owner: str) -> bool:
+    now = datetime.utcnow()
+    try:
+        with engine.begin() as conn:
+            released = conn.execute(delete(BVLock).where(
+                BVLock.bv_id == bv_id,
+                BVLock.acquired_at < now - timedelta(seconds=config.BV_LOCK_TTL),
+            )).rowcount
+            conn.execute(insert(BVLock).values(bv_id=bv_id, owner=owner, acquired_at=now))
+    except IntegrityError:
+        return False
+    except OperationalError:
+        # SQLite: another connection holds the write lock ("database is locked")
+        return False
+    if released:
+        with _stats_lock:
+            _stats["stale_released"] += released
+    return True
+
+
+def _heartbeat(engine, bv_id: int, owner: str, stop: threading.Event):
+    """Refresh the lock's acquired_at every quarter TTL until `stop` is set."""
+    while not stop.wait(config.BV_LOCK_TTL / 4):
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    update(BVLock)
+                    .where(BVLock.bv_id == bv_id, BVLock.owner == owner)
+                    .values(acquired_at=datetime.utcnow())
+                )
+        except OperationalError:
+            # SQLite busy; the next beat is still well within the TTL
+            continue
+
+
+def _record(waited: float, contended: bool, timed_out: bool = False):
+    with _stats_lock:
+        if timed_out:
+            _stats["timeouts"] += 1
+        else:
+            _stats["acquired"] += 1
+        _stats["contended"] += contended
+        _stats["wait_seconds"] += waited
+        _stats["max_wait_seconds"] = max(_stats["max_wait_seconds"], waited)
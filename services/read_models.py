@@ -0,0 +1,72 @@
+"""Read-only row types for the reporting paths.
+
+Views and reports only read a handful of columns. These NamedTuples are
+filled straight from column queries: no per-instance __dict__, identity map,
+change tracking or relationship loaders. Anything that writes still goes
+through the ORM models.
+"""
+
+from datetime import date
+from typing import NamedTuple, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import Transaction, Holding
+
+
+class TransactionRow(NamedTuple):
+    id: Optional[int]
+    bv_id: int
+    date: date
+    type: str
+    ticker: Optional[str]
+    description: str
+    quantity: Optional[float]
+    price: Optional[float]
+    amount: float
+
+
+class HoldingRow(NamedTuple):
+    ticker: str
+    name: str
+    quantity: float
+    avg_cost_price: float
+    total_cost: float
+
+
+def _columns(model, row_type):
+    return [getattr(model, field) for field in row_type._fields]
+
+
+def transaction_rows(db: Session, bv_id: int, tx_type: str = "", year: Optional[int] = None) -> list[TransactionRow]:
+    """A BV's transactions, newest first, optionally filtered on type and year."""
+    query = select(*_columns(Transaction, TransactionRow)).where(Transaction.bv_id == bv_id)
+    if tx_type:
+        query = query.where(Transaction.type == tx_type)
+    if year:
+        query = query.where(Transaction.date >= date(year, 1, 1), Transaction.date <= date(year, 12, 31))
+    return [TransactionRow._make(row) for row in db.execute(query.order_by(Transaction.date.desc()))]
+
+
+def trade_rows(db: Session, bv_id: int, until: date, after: Optional[date] = None) -> list[TransactionRow]:
+    """Processed buys and sells with after < date <= until, in engine order."""
+    query = select(*_columns(Transaction, TransactionRow)).where(
+        Transaction.bv_id == bv_id,
+        Transaction.processed == True,  # noqa: E712
+        Transaction.type.in_(("buy", "sell")),
+        Transaction.date <= until,
+    )
+    if after:
+        query = query.where(Transaction.date > after)
+    return [TransactionRow._make(row) for row in db.execute(query.order_by(Transaction.date, Transaction.id))]
+
+
+def holding_rows(db: Session, bv_id: int) -> list[HoldingRow]:
+    query = select(*_columns(Holding, HoldingRow)).where(Holding.bv_id == bv_id).order_by(Holding.ticker)
+    return [HoldingRow._make(row) for row in db.execute(query)]
+
+
+def transaction_years(db: Session, bv_id: int) -> list[int]:
+    """Years with at least one transaction, newest first, from the rollups."""
+    from services.rollups import years
+    return years(db, bv_id)
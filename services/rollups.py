@@ -0,0 +1,193 @@
+"""Per-BV, per-month, per-type transaction totals kept in transaction_rollups.
+
+The dashboard, the /transactions year list, the annual report and the VPB
+aangifte only need sums and counts per type over whole years. They read a
+few dozen rollup rows instead of scanning the BV's transactions; most go
+through the columnar ledger cache (services/ledger_cache.py), which is
+reloaded when a change bumps bvs.rollup_version.
+
+Rows are maintained in the same transaction as the data they summarize:
+- bulk_insert_transactions adds the new rows' counts and amounts, and
+  Transaction objects inserted through the ORM are added per flush
+  (after_flush hook in models.py);
+- the transaction engine adds (and on a rewind removes) each sell's
+  gain_adjustment: stored gain minus proceeds. A year's realized result is
+  then amount + gain_adjustment of its sells, i.e. the stored gain where the
+  engine recorded one and the proceeds otherwise, as the report expects.
+
+Processing does not change a transaction's date, type or amount, so the
+counts and amounts need no other updates. Writers hold the BV's lock
+(services/locks.py), so read-modify-write per BV is safe. Anything that
+changes transactions outside these paths should call rebuild().
+
+Usage: python -m services.rollups [--bv ID ...] [--db URL]
+"""
+
+import argparse
+from collections import defaultdict
+from datetime import date
+from typing import Iterable, Optional
+from sqlalchemy import BigInteger, and_, bindparam, cast, delete, extract, func, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+from models import BV, RealizedGain, Transaction, TransactionRollup, from_cents, to_cents
+
+
+def years(db: Session, bv_id: int) -> list[int]:
+    """Years with at least one transaction, newest first."""
+    r = TransactionRollup
+    rows = db.execute(
+        select(r.year).where(r.bv_id == bv_id, r.tx_count > 0).distinct().order_by(r.year.desc())
+    )
+    return [year for (year,) in rows]
+
+
+def record_transactions(db: Session, bv_id: int, rows: Iterable[dict]):
+    """Add newly inserted transaction rows (dicts with date, type, amount)."""
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for row in rows:
+        cents = to_cents(row["amount"])
+        delta = deltas[(row["date"].year, row["date"].month, row["type"])]
+        delta[0] += 1
+        delta[1] += cents
+        delta[2] += abs(cents)
+    _apply(db, bv_id, deltas)
+
+
+def record_gains(db: Session, bv_id: int, gains: Iterable[dict], sign: int = 1):
+    """Add (sign=1) or remove (sign=-1) realized gains (dicts with date, proceeds, gain)."""
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for gain in gains:
+        deltas[(gain["date"].year, gain["date"].month, "sell")][3] += (
+            sign * (to_cents(gain["gain"]) - to_cents(gain["proceeds"]))
+        )
+    _apply(db, bv_id, deltas)
+
+
+def forget_gains(db: Session, bv_id: int, after: date):
+    """Remove the gains dated after `after`; call before deleting them."""
+    rows = db.execute(
+        select(RealizedGain.date, RealizedGain.proceeds, RealizedGain.gain)
+        .where(RealizedGain.bv_id == bv_id, RealizedGain.date > after)
+    ).mappings()
+    record_gains(db, bv_id, rows, sign=-1)
+
+
+def rebuild(db: Session, bv_id: Optional[int] = None, since: Optional[date] = None) -> int:
+    """Recompute rollup rows from transactions and realized gains.
+
+    Limited to one BV and/or to the months from `since` on. The caller
+    commits. Returns the number of rollup rows written.
+    """
+    r = TransactionRollup
+    tx = Transaction
+    cents = cast(tx.amount, BigInteger)
+    year, month = extract("year", tx.date), extract("month", tx.date)
+
+    stale, source = [], []
+    if bv_id is not None:
+        stale.append(r.bv_id == bv_id)
+        source.append(tx.bv_id == bv_id)
+    if since:
+        stale.append(or_(r.year > since.year, and_(r.year == since.year, r.month >= since.month)))
+        source.append(tx.date >= date(since.year, since.month, 1))
+
+    aggregates = (
+        select(
+            tx.bv_id, year, month, tx.type,
+            func.count(),
+            func.sum(cents),
+            func.sum(func.abs(cents)),
+            func.coalesce(func.sum(
+                cast(RealizedGain.gain, BigInteger) - cast(RealizedGain.proceeds, BigInteger)
+            ), 0),
+        )
+        .select_from(tx)
+        .outerjoin(RealizedGain, RealizedGain.sell_tx_id == tx.id)
+        .where(*source)
+        .group_by(tx.bv_id, year, month, tx.type)
+    )
+    db.execute(delete(r).where(*stale))
+    result = db.execute(insert(r).from_select(
+        ["bv_id", "year", "month", "type", "tx_count", "amount", "abs_amount", "gain_adjustment"],
+        aggregates,
+    ))
+    bump = update(BV).values(rollup_version=func.coalesce(BV.rollup_version, 0) + 1)
+    db.execute(bump.where(BV.id == bv_id) if bv_id is not None else bump)
+    return result.rowcount
+
+
+def _apply(db: Session, bv_id: int, deltas: dict):
+    """Add [count, amount, abs_amount, gain_adjustment] deltas (cents) per (year, month, type).
+
+    One lookup for the existing keys, then one executemany UPDATE and one
+    INSERT for the rest. Bumps the BV's rollup_version for the ledger cache.
+    """
+    if not deltas:
+        return
+    r = TransactionRollup
+    existing = set(db.execute(
+        select(r.year, r.month, r.type)
+        .where(r.bv_id == bv_id, r.year.in_({year for year, _, _ in deltas}))
+    ).tuples())
+
+    updates, inserts = [], []
+    for (year, month, tx_type), (count, amount, abs_amount, adjustment) in deltas.items():
+        if (year, month, tx_type) in existing:
+            updates.append({
+                "b_year": year, "b_month": month, "b_type": tx_type, "b_count": count,
+                "b_amount": amount, "b_abs_amount": abs_amount, "b_adjustment": adjustment,
+            })
+        else:
+            inserts.append({
+                "bv_id": bv_id, "year": year, "month": month, "type": tx_type, "tx_count": count,
+                "amount": from_cents(amount), "abs_amount": from_cents(abs_amount),
+                "gain_adjustment": from_cents(adjustment),
+            })
+
+    if updates:
+        table = r.__table__
+        c = table.c
+        db.execute(
+            update(table)
+            .where(c.bv_id == bv_id, c.year == bindparam("b_year"), c.month == bindparam("b_month"),
+                   c.type == bindparam("b_type"))
+            .values(
+                tx_count=c.tx_count + bindparam("b_count"),
+                # Deltas are in cents, like the stored values
+                amount=cast(c.amount, BigInteger) + bindparam("b_amount", type_=BigInteger),
+                abs_amount=cast(c.abs_amount, BigInteger) + bindparam("b_abs_amount", type_=BigInteger),
+                gain_adjustment=cast(c.gain_adjustment, BigInteger) + bindparam("b_adjustment", type_=BigInteger),
+            ),
+            updates,
+        )
+    if inserts:
+        db.execute(insert(r), inserts)
+    db.execute(
+        update(BV).where(BV.id == bv_id).values(rollup_version=func.coalesce(BV.rollup_version, 0) + 1)
+    )
+
+
+if __name__ == "__main__":
+    import config
+    from models import BV, init_db
+
+    parser = argparse.ArgumentParser(description="Rebuild the transaction rollups from the ledger.")
+    parser.add_argument("--bv", type=int, action="append", help="limit to these BV ids")
+    parser.add_argument("--db", default=config.DATABASE_URL)
+    args = parser.parse_args()
+
+    _, Session = init_db(args.db)
+    db = Session()
+    try:
+        from services.locks import bv_lock
+
+        bv_ids = args.bv or [bv_id for (bv_id,) in db.query(BV.id).order_by(BV.id)]
+        written = 0
+        for bv_id in bv_ids:
+            with bv_lock(db, bv_id):
+                written += rebuild(db, bv_id)
+                db.commit()
+        print(f"Rollups: {written} rijen herberekend voor {len(bv_ids)} BVs")
+    finally:
+        db.close()
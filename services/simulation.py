@@ -0,0 +1,198 @@
+"""What-if simulation: hypothetical trades → W&V, balans and VPB, without DB writes."""
+
+import threading
+from collections import OrderedDict, deque
+from datetime import date
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+
+from models import BV, Transaction, Holding
+from services.read_models import TransactionRow
+
+_STATE_CACHE_SIZE = 256
+_states = OrderedDict()  # (bv_id, year) -> base state, see _base_state
+_states_lock = threading.Lock()
+
+
+class _CopyOnWrite(dict):
+    """Overlay on a shared base map.
+
+    A base value is copied the first time it is looked up, so the engine can
+    mutate it freely while the cached base state stays untouched.
+    """
+
+    def __init__(self, base: dict, copy, default=None):
+        super().__init__()
+        self._base = base
+        self._copy = copy
+        self._default = default
+
+    def __missing__(self, key):
+        if key in self._base:
+            value = self._copy(self._base[key])
+        elif self._default:
+            value = self._default()
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def merged(self) -> dict:
+        return {**self._base, **self}
+
+
+def simulate(db: Session, bv_id: int, year: int, trades: list[dict]) -> dict:
+    """Apply hypothetical trades at the end of `year` and recompute the report.
+
+    Each trade is {type: "buy"/"sell", ticker, quantity, price or amount,
+    fee (optional)}. The BV's year-end state is built once and cached until
+    its transactions change; every call works on copy-on-write views of it.
+
+    Returns {winst_verlies, balans, vpb, effecten, verschil} where verschil
+    holds the change against the report without the trades.
+    """
+    from services.annual_report import _add_vpb, _balans, _winst_verlies
+    from services.transaction_engine import _positions, _process_buy, _process_sell
+    from services.vpb import vpb_breakdown
+
+    if not isinstance(trades, list) or not all(isinstance(trade, dict) for trade in trades):
+        raise ValueError("Ongeldige trades: verwacht een lijst van transacties")
+
+    state = _base_state(db, bv_id, year)
+    holdings = _CopyOnWrite(state["holdings"], _copy_holding)
+    lots = _CopyOnWrite(state["lots"], lambda open_lots: deque(dict(lot) for lot in open_lots), deque)
+    ledger = {"lots": lots, "new_lots": [], "closed": [], "gains": []}
+
+    components = dict(state["components"])
+    cash = state["cash"]
+    for trade in trades:
+        tx = _hypothetical_tx(bv_id, year, trade)
+        if tx.type == "buy":
+            _process_buy(None, tx, holdings, ledger)
+            cash -= abs(tx.amount)
+        else:
+            holding = holdings.get(tx.ticker)
+            available = holding.quantity if holding else 0.0
+            if tx.quantity > available + 0.001:
+                raise ValueError(f"Niet genoeg {tx.ticker} in portefeuille ({available:g} stuks)")
+            components["realized_gains"] += _process_sell(None, tx, holdings, ledger, state["method"])
+            cash += abs(tx.amount)
+
+        fee = _fee(trade)
+        components["transaction_costs"] += fee
+        cash -= fee
+
+    base_wv = state["wv"]
+    wv = _winst_verlies(**components)
+    _add_vpb(wv)
+
+    positions = _positions(holdings.merged())
+    effecten = sum(p["total_cost"] for p in positions.values())
+
+    return {
+        "year": year,
+        "winst_verlies": wv,
+        "balans": _balans(effecten, cash, state["gestort_kapitaal"], wv),
+        "vpb": vpb_breakdown(wv["resultaat_voor_belasting"]),
+        "effecten": positions,
+        "verschil": {
+            "gerealiseerde_koersresultaten": round(wv["gerealiseerde_koersresultaten"] - base_wv["gerealiseerde_koersresultaten"], 2),
+            "resultaat_voor_belasting": round(wv["resultaat_voor_belasting"] - base_wv["resultaat_voor_belasting"], 2),
+            "vpb": round(wv["vpb"] - base_wv["vpb"], 2),
+        },
+    }
+
+
+def _base_state(db: Session, bv_id: int, year: int) -> dict:
+    """Year-end engine state plus the report figures the trades build on.
+
+    Cached per (bv_id, year); a version check of one query decides whether
+    the cached state still matches the BV's transactions and cost method.
+    """
+    from services.annual_report import _add_vpb, _winst_verlies, _year_totals
+    from services.transaction_engine import state_as_of
+
+    version = tuple(
+        db.query(
+            func.max(Transaction.id),
+            func.count(Transaction.id),
+            func.count(case((Transaction.processed == True, 1))),  # noqa: E712
+        )
+        .filter(Transaction.bv_id == bv_id)
+        .one()
+    ) + (db.query(BV.cost_method).filter_by(id=bv_id).scalar(),)
+
+    key = (bv_id, year)
+    with _states_lock:
+        state = _states.get(key)
+        if state and state["version"] == version:
+            _states.move_to_end(key)
+            return state
+
+    holdings, ledger, method = state_as_of(db, bv_id, date(year, 12, 31))
+    components, cash, gestort_kapitaal = _year_totals(db, bv_id, year)
+    wv = _winst_verlies(**components)
+    _add_vpb(wv)
+    state = {
+        "version": version,
+        "holdings": holdings,
+        "lots": dict(ledger["lots"]),
+        "method": method,
+        "components": components,
+        "wv": wv,
+        "cash": cash,
+        "gestort_kapitaal": gestort_kapitaal,
+    }
+
+    with _states_lock:
+        _states[key] = state
+        _states.move_to_end(key)
+        while len(_states) > _STATE_CACHE_SIZE:
+            _states.popitem(last=False)
+    return state
+
+
+def _fee(trade: dict) -> float:
+    try:
+        return abs(float(trade.get("fee") or 0))
+    except (TypeError, ValueError):
+        raise ValueError("Ongeldige transactiekosten")
+
+
+def _copy_holding(h: Holding) -> Holding:
+    return Holding(bv_id=h.bv_id, ticker=h.ticker, name=h.name, quantity=h.quantity,
+                   avg_cost_price=h.avg_cost_price, total_cost=h.total_cost)
+
+
+def _hypothetical_tx(bv_id: int, year: int, trade: dict) -> TransactionRow:
+    """Engine input for a trade dict; raises ValueError on bad input."""
+    tx_type = trade.get("type")
+    ticker = str(trade.get("ticker") or "").strip()
+    try:
+        quantity = float(trade.get("quantity") or 0)
+        if trade.get("amount") is not None:
+            amount = abs(float(trade["amount"]))
+        else:
+            amount = quantity * float(trade.get("price") or 0)
+    except (TypeError, ValueError):
+        raise ValueError("Ongeldig aantal of bedrag")
+    if tx_type not in ("buy", "sell") or not ticker or quantity <= 0:
+        raise ValueError("Ongeldige transactie: type (buy/sell), ticker en aantal zijn verplicht")
+
+    return TransactionRow(
+        id=None,
+        bv_id=bv_id,
+        date=date(year, 12, 31),
+        type=tx_type,
+        ticker=ticker,
+        description=ticker,
+        quantity=quantity,
+        price=amount / quantity,
+        amount=-amount if tx_type == "buy" else amount,
+    )
@@ -1,56 +1,259 @@
 """Process transactions into holdings and track realized gains."""
 
-from models import Transaction, Holding
+import calendar
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import date
+from typing import Callable, Optional
+from sqlalchemy import bindparam, delete, event, func, insert, select, update
+from models import BV, Transaction, Holding, Lot, RealizedGain, HoldingCheckpoint, from_cents, to_cents
 from sqlalchemy.orm import Session
 
+# Rows per commit when process_transactions reports progress
+PROGRESS_CHUNK_SIZE = 5000
 
-def process_transactions(db: Session, bv_id: int) -> dict:
+
+def process_transactions(db: Session, bv_id: int,
+                         on_progress: Optional[Callable[[dict], None]] = None,
+                         chunk_size: int = PROGRESS_CHUNK_SIZE) -> dict:
     """Process all unprocessed transactions for a BV.
 
-    Returns summary: {processed: int, realized_gains: float, errors: []}
+    Holdings and open lots are loaded once into ticker maps, the whole batch
+    is applied in memory and the changes are written in one flush plus a few
+    executemany statements for the lot ledger. Every
+    buy opens a lot; every sell stores its realized gain, with the cost basis
+    taken from the BV's cost_method (average or fifo).
+
+    Whenever the batch crosses a month end, the positions at that month end
+    are stored as a HoldingCheckpoint (see holdings_as_of).
+
+    Rows dated before already processed ones (a late import) are not applied
+    out of order: the ledger is rewound to the last checkpoint before them
+    and everything after that checkpoint is replayed. `replayed_from` is the
+    checkpoint date, or None when nothing was rewound (or the replay had to
+    start from scratch); `processed` and `realized_gains` then include the
+    replayed rows, `replayed` counts them.
+
+    With `on_progress`, the work is committed every `chunk_size` rows and
+    on_progress(summary) is called just before each of those commits, so
+    changes it makes to the session (e.g. a job's progress) are committed
+    with the chunk. A failure then keeps the chunks already committed; the
+    next run carries on with the rows still unprocessed.
+
+    Returns summary: {processed: int, replayed: int, realized_gains: float,
+    errors: [], replayed_from: str | None, queries: int, queries_per_tx: float}
     """
-    transactions = (
+    with count_queries(db) as queries:
+        summary = {"processed": 0, "replayed": 0, "realized_gains": 0.0, "errors": [], "replayed_from": None}
+
+        transactions = _unprocessed(db, bv_id)
+        last_date = (
+            db.query(func.max(Transaction.date))
+            .filter_by(bv_id=bv_id, processed=True)
+            .scalar()
+        )
+        new_ids = None
+        if transactions and last_date and transactions[0].date < last_date:
+            # Back-dated rows: rewind to the checkpoint before them and replay
+            new_ids = {tx.id for tx in transactions}
+            last_date = _rewind(db, bv_id, transactions[0].date)
+            summary["replayed_from"] = last_date.isoformat() if last_date else None
+            transactions = _unprocessed(db, bv_id)
+
+        holdings = {h.ticker: h for h in db.query(Holding).filter_by(bv_id=bv_id)}
+        ledger = _load_ledger(db, bv_id)
+        method = db.query(BV.cost_method).filter_by(id=bv_id).scalar() or "average"
+
+        for i, tx in enumerate(transactions):
+            if on_progress and i and i % chunk_size == 0:
+                on_progress(summary)
+                ledger = _commit_chunk(db, bv_id, holdings, ledger)
+            if last_date and tx.date > _month_end(last_date):
+                _write_checkpoint(db, bv_id, _month_end(last_date), holdings, ledger)
+            if not last_date or tx.date > last_date:
+                last_date = tx.date
+            try:
+                if tx.type == "buy":
+                    _process_buy(db, tx, holdings, ledger)
+                elif tx.type == "sell":
+                    gain = _process_sell(db, tx, holdings, ledger, method)
+                    summary["realized_gains"] += gain
+                # dividend, interest, cost, deposit, withdrawal don't affect holdings
+                tx.processed = True
+                summary["processed"] += 1
+                if new_ids is not None and tx.id not in new_ids:
+                    summary["replayed"] += 1
+            except Exception as e:
+                summary["errors"].append(f"TX #{tx.id}: {str(e)}")
+
+        _drop_closed_positions(db, holdings)
+        _write_ledger(db, bv_id, ledger)
+        if on_progress:
+            on_progress(summary)
+        db.commit()
+
+    summary["queries"] = queries["count"]
+    summary["queries_per_tx"] = round(queries["count"] / summary["processed"], 3) if summary["processed"] else 0
+    return summary
+
+
+def _commit_chunk(db: Session, bv_id: int, holdings: dict, ledger: dict) -> dict:
+    """Write and commit the work so far; returns a fresh ledger to continue with.
+
+    The loaded transactions and holdings stay in use (the BV lock keeps
+    other writers out), so the commit does not expire them. New lots are
+    read back with their ids.
+    """
+    _drop_closed_positions(db, holdings)
+    _write_ledger(db, bv_id, ledger)
+    expire_on_commit, db.expire_on_commit = db.expire_on_commit, False
+    try:
+        db.commit()
+    finally:
+        db.expire_on_commit = expire_on_commit
+    return _load_ledger(db, bv_id)
+
+
+def _unprocessed(db: Session, bv_id: int) -> list:
+    return (
         db.query(Transaction)
         .filter_by(bv_id=bv_id, processed=False)
-        .order_by(Transaction.date)
+        .order_by(Transaction.date, Transaction.id)
         .all()
     )
 
-    summary = {"processed": 0, "realized_gains": 0.0, "errors": []}
-
-    for tx in transactions:
-        try:
-            if tx.type == "buy":
-                _process_buy(db, tx)
-            elif tx.type == "sell":
-                gain = _process_sell(db, tx)
-                summary["realized_gains"] += gain
-            # dividend, interest, cost, deposit, withdrawal don't affect holdings
-            tx.processed = True
-            summary["processed"] += 1
-        except Exception as e:
-            summary["errors"].append(f"TX #{tx.id}: {str(e)}")
-
-    db.commit()
-    return summary
 
+def _rewind(db: Session, bv_id: int, before: date) -> date | None:
+    """Reset the BV's ledger to the latest checkpoint dated before `before`.
+
+    Holdings and lot quantities are restored from the checkpoint; lots,
+    realized gains and checkpoints after it are deleted and the transactions
+    after it are marked unprocessed again, so the next pass replays only
+    that window. Without such a checkpoint the whole history is replayed.
 
-def _process_buy(db: Session, tx: Transaction):
-    """Buy: add to holdings, recalculate weighted average cost price."""
+    Returns the checkpoint date, or None.
+    """
+    from services.rollups import forget_gains
+
+    checkpoint = (
+        db.query(HoldingCheckpoint)
+        .filter(HoldingCheckpoint.bv_id == bv_id, HoldingCheckpoint.as_of < before)
+        .order_by(HoldingCheckpoint.as_of.desc())
+        .first()
+    )
+    as_of = checkpoint.as_of if checkpoint else date.min
+    positions = checkpoint.positions if checkpoint else {}
+    open_lots = checkpoint.lots if checkpoint else []
+
+    db.execute(delete(HoldingCheckpoint).where(
+        HoldingCheckpoint.bv_id == bv_id, HoldingCheckpoint.as_of > as_of
+    ))
+    forget_gains(db, bv_id, as_of)
+    db.execute(delete(RealizedGain).where(RealizedGain.bv_id == bv_id, RealizedGain.date > as_of))
+    db.execute(delete(Lot).where(Lot.bv_id == bv_id, Lot.date > as_of))
+    # Lots closed at the checkpoint stay closed (sells only lower quantities),
+    # so only the checkpoint's open lots need their quantity restored
+    if open_lots:
+        db.execute(
+            update(Lot.__table__)
+            .where(Lot.bv_id == bv_id, Lot.buy_tx_id == bindparam("b_buy_tx_id"))
+            .values(remaining_quantity=bindparam("b_remaining")),
+            [{"b_buy_tx_id": lot[1], "b_remaining": lot[5]} for lot in open_lots],
+        )
+    db.execute(
+        update(Transaction)
+        .where(Transaction.bv_id == bv_id, Transaction.processed == True, Transaction.date > as_of)  # noqa: E712
+        .values(processed=False)
+    )
+
+    db.execute(delete(Holding).where(Holding.bv_id == bv_id))
+    if positions:
+        db.execute(insert(Holding), [
+            {"bv_id": bv_id, "ticker": ticker, **p} for ticker, p in positions.items()
+        ])
+    return checkpoint.as_of if checkpoint else None
+
+
+@contextmanager
+def count_queries(db: Session):
+    """Count SQL statements this session sends while the block runs.
+
+    An executemany counts as one statement. Yields {"count": int}.
+    """
+    counter = {"count": 0}
+    conn = db.connection()
+
+    def before_cursor_execute(*args):
+        counter["count"] += 1
+
+    event.listen(conn, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(conn, "before_cursor_execute", before_cursor_execute)
+
+
+def _load_ledger(db: Session, bv_id: int) -> dict:
+    """Open lots per ticker (oldest first) plus buffers for new ledger rows.
+
+    Lots are plain dicts; new ones have id None. They are written in bulk by
+    _write_ledger, which avoids a RETURNING round trip per ORM object.
+    """
+    lots = defaultdict(deque)
+    rows = db.execute(
+        select(Lot.id, Lot.ticker, Lot.buy_tx_id, Lot.date, Lot.quantity, Lot.cost, Lot.remaining_quantity)
+        .where(Lot.bv_id == bv_id, Lot.remaining_quantity > 0.001)
+        .order_by(Lot.date, Lot.id)
+    ).mappings()
+    for row in rows:
+        lots[row["ticker"]].append(dict(row, changed=False))
+    return {"lots": lots, "new_lots": [], "closed": [], "gains": []}
+
+
+def _write_ledger(db: Session, bv_id: int, ledger: dict):
+    """Persist new lots, consumed lot quantities and realized gains."""
+    from services.rollups import record_gains
+
+    if ledger["new_lots"]:
+        db.execute(insert(Lot), [
+            {k: v for k, v in lot.items() if k not in ("id", "changed")}
+            for lot in ledger["new_lots"]
+        ])
+    changed = [
+        {"id": lot["id"], "remaining_quantity": lot["remaining_quantity"]}
+        for open_lots in ledger["lots"].values()
+        for lot in open_lots
+        if lot["id"] is not None and lot["changed"]
+    ] + ledger["closed"]
+    if changed:
+        db.execute(update(Lot), changed)
+    if ledger["gains"]:
+        db.execute(insert(RealizedGain), ledger["gains"])
+        record_gains(db, bv_id, ledger["gains"])
+
+
+def _process_buy(db: Session, tx: Transaction, holdings: dict, ledger: dict):
+    """Buy: open a lot, add to holdings, recalculate weighted average cost price."""
     if not tx.ticker or not tx.quantity:
         return
 
-    holding = db.query(Holding).filter_by(bv_id=tx.bv_id, ticker=tx.ticker).first()
+    holding = holdings.get(tx.ticker)
 
     buy_cost = abs(tx.amount)  # total cost of this buy
 
+    if holding and holding.quantity <= 0.001:
+        # Position was closed earlier in this batch; reopen from scratch
+        holding.quantity = 0
+        holding.avg_cost_price = 0
+        holding.total_cost = 0
+        holding.name = tx.description
+
     if holding:
-        old_total = holding.quantity * holding.avg_cost_price
-        new_total = old_total + buy_cost
+        new_total = from_cents(to_cents(holding.total_cost) + to_cents(buy_cost))
         new_qty = holding.quantity + tx.quantity
         holding.avg_cost_price = new_total / new_qty if new_qty > 0 else 0
         holding.quantity = new_qty
-        holding.total_cost = new_qty * holding.avg_cost_price
+        holding.total_cost = new_total
     else:
         avg_price = buy_cost / tx.quantity if tx.quantity > 0 else 0
         holding = Holding(
@@ -61,38 +264,254 @@ def _process_buy(db: Session, tx: Transaction):
             avg_cost_price=avg_price,
             total_cost=buy_cost,
         )
-        db.add(holding)
+        if db is not None:
+            db.add(holding)
+        holdings[tx.ticker] = holding
+
+    lot = {
+        "id": None,
+        "bv_id": tx.bv_id,
+        "ticker": tx.ticker,
+        "buy_tx_id": tx.id,
+        "date": tx.date,
+        "quantity": tx.quantity,
+        "cost": buy_cost,
+        "remaining_quantity": tx.quantity,
+        "changed": False,
+    }
+    ledger["new_lots"].append(lot)
+    ledger["lots"][tx.ticker].append(lot)
 
 
-def _process_sell(db: Session, tx: Transaction) -> float:
-    """Sell: reduce holdings, calculate realized gain/loss.
+def _process_sell(db: Session, tx: Transaction, holdings: dict, ledger: dict, method: str = "average") -> float:
+    """Sell: reduce holdings and lots, store the realized gain/loss.
 
     Returns realized gain (positive) or loss (negative).
     """
     if not tx.ticker or not tx.quantity:
         return 0.0
 
-    holding = db.query(Holding).filter_by(bv_id=tx.bv_id, ticker=tx.ticker).first()
+    holding = holdings.get(tx.ticker)
 
-    if not holding:
+    # No position, or one already closed earlier in this batch
+    if not holding or holding.quantity <= 0.001:
         return 0.0
 
+    # Money is computed in integer cents so gains and cost bases add up exactly
     sell_qty = tx.quantity
-    sell_proceeds = abs(tx.amount)
-    cost_basis = sell_qty * holding.avg_cost_price
-    realized_gain = sell_proceeds - cost_basis
+    proceeds = to_cents(abs(tx.amount))
+    total = to_cents(holding.total_cost)
+    fifo_cost = _consume_lots(ledger, tx.ticker, sell_qty, holding.avg_cost_price)
 
-    # Update holding
-    holding.quantity -= sell_qty
-    holding.total_cost = holding.quantity * holding.avg_cost_price
+    if method == "fifo":
+        cost_basis = fifo_cost
+        holding.quantity -= sell_qty
+        holding.total_cost = from_cents(max(total - cost_basis, 0))
+        if holding.quantity > 0.001:
+            holding.avg_cost_price = holding.total_cost / holding.quantity
+    else:
+        # Proportional share of the position's cost; selling everything takes all of it
+        cost_basis = round(total * sell_qty / holding.quantity)
+        holding.quantity -= sell_qty
+        holding.total_cost = from_cents(total - cost_basis)
+
+    realized_gain = from_cents(proceeds - cost_basis)
 
-    # Remove holding if fully sold
-    if holding.quantity <= 0.001:
-        db.delete(holding)
+    ledger["gains"].append({
+        "bv_id": tx.bv_id,
+        "ticker": tx.ticker,
+        "sell_tx_id": tx.id,
+        "date": tx.date,
+        "quantity": sell_qty,
+        "proceeds": from_cents(proceeds),
+        "cost_basis": from_cents(cost_basis),
+        "gain": realized_gain,
+        "method": method,
+    })
 
+    # Fully sold holdings are removed at the end of the batch
     return realized_gain
 
 
+def _consume_lots(ledger: dict, ticker: str, quantity: float, fallback_price: float) -> int:
+    """Take `quantity` from the oldest lots first; return the FIFO cost of it in cents.
+
+    A lot's cost is split over its sells by cumulative share, so the parts
+    always add up to the lot's cost. Quantity not covered by lots (positions
+    from before the lot ledger) is valued at `fallback_price`.
+    """
+    open_lots = ledger["lots"][ticker]
+    cost = 0
+    while quantity > 0.001 and open_lots:
+        lot = open_lots[0]
+        take = min(quantity, lot["remaining_quantity"])
+        lot_cost = to_cents(lot["cost"])
+        consumed = lot["quantity"] - lot["remaining_quantity"]
+        cost += (round(lot_cost * (consumed + take) / lot["quantity"])
+                 - round(lot_cost * consumed / lot["quantity"]))
+        lot["remaining_quantity"] -= take
+        lot["changed"] = True
+        quantity -= take
+        if lot["remaining_quantity"] <= 0.001:
+            open_lots.popleft()
+            if lot["id"] is not None:
+                ledger["closed"].append({"id": lot["id"], "remaining_quantity": 0.0})
+    if quantity > 0.001:
+        cost += to_cents(quantity * fallback_price)
+    return cost
+
+
+def _drop_closed_positions(db: Session, holdings: dict):
+    """Delete holdings whose position was fully sold during the batch."""
+    for ticker, holding in list(holdings.items()):
+        if holding.quantity <= 0.001:
+            if holding in db.new:
+                db.expunge(holding)
+            else:
+                db.delete(holding)
+            del holdings[ticker]
+
+
+def holdings_as_of(db: Session, bv_id: int, as_of: date) -> dict:
+    """Positions of a BV at the end of `as_of`, without touching the holdings table.
+
+    Starts from the latest checkpoint on or before `as_of` and replays the
+    processed buys and sells after it in memory. Without a checkpoint the
+    replay starts from an empty portfolio.
+
+    Returns {ticker: {name, quantity, avg_cost_price, total_cost}}.
+    """
+    holdings, _, _ = state_as_of(db, bv_id, as_of)
+    return _positions(holdings)
+
+
+def state_as_of(db: Session, bv_id: int, as_of: date) -> tuple[dict, dict, str]:
+    """Detached engine state at the end of `as_of`, see holdings_as_of.
+
+    Returns (holdings map, ledger, cost method); the holdings are transient
+    Holding objects that _process_buy/_process_sell can keep applying to.
+    """
+    checkpoint = (
+        db.query(HoldingCheckpoint)
+        .filter(HoldingCheckpoint.bv_id == bv_id, HoldingCheckpoint.as_of <= as_of)
+        .order_by(HoldingCheckpoint.as_of.desc())
+        .first()
+    )
+    holdings, ledger = _restore_checkpoint(bv_id, checkpoint)
+    method = db.query(BV.cost_method).filter_by(id=bv_id).scalar() or "average"
+
+    from services.read_models import trade_rows
+    for tx in trade_rows(db, bv_id, as_of, checkpoint.as_of if checkpoint else None):
+        _replay(tx, holdings, ledger, method)
+
+    return holdings, ledger, method
+
+
+def holdings_at(db: Session, bv_id: int, dates: list[date]) -> dict[date, dict]:
+    """Positions at the end of each of `dates`, like holdings_as_of, in one pass.
+
+    Dates with a checkpoint of their own (month ends, so year ends) are read
+    from it. The others are filled by a single replay in date order, from the
+    latest checkpoint before the earliest of them.
+
+    Returns {date: {ticker: {name, quantity, avg_cost_price, total_cost}}}.
+    """
+    from services.read_models import trade_rows
+
+    dates = sorted(set(dates))
+    stored = {
+        cp.as_of: cp
+        for cp in db.query(HoldingCheckpoint).filter(
+            HoldingCheckpoint.bv_id == bv_id, HoldingCheckpoint.as_of.in_(dates)
+        )
+    }
+    result = {day: _positions(_restore_checkpoint(bv_id, cp)[0]) for day, cp in stored.items()}
+    missing = [day for day in dates if day not in stored]
+    if not missing:
+        return result
+
+    checkpoint = (
+        db.query(HoldingCheckpoint)
+        .filter(HoldingCheckpoint.bv_id == bv_id, HoldingCheckpoint.as_of <= missing[0])
+        .order_by(HoldingCheckpoint.as_of.desc())
+        .first()
+    )
+    holdings, ledger = _restore_checkpoint(bv_id, checkpoint)
+    method = db.query(BV.cost_method).filter_by(id=bv_id).scalar() or "average"
+
+    pending = iter(missing)
+    target = next(pending)
+    for tx in trade_rows(db, bv_id, missing[-1], checkpoint.as_of if checkpoint else None):
+        while tx.date > target:
+            result[target] = _positions(holdings)
+            target = next(pending)
+        _replay(tx, holdings, ledger, method)
+    result[target] = _positions(holdings)
+    for day in pending:
+        result[day] = _positions(holdings)
+    return result
+
+
+def _replay(tx, holdings: dict, ledger: dict, method: str):
+    """Apply a processed buy or sell to detached state (no DB writes)."""
+    if tx.type == "buy":
+        _process_buy(None, tx, holdings, ledger)
+    else:
+        _process_sell(None, tx, holdings, ledger, method)
+
+
+def _month_end(day: date) -> date:
+    return date(day.year, day.month, calendar.monthrange(day.year, day.month)[1])
+
+
+def _positions(holdings: dict) -> dict:
+    return {
+        ticker: {
+            "name": h.name,
+            "quantity": h.quantity,
+            "avg_cost_price": h.avg_cost_price,
+            "total_cost": h.total_cost,
+        }
+        for ticker, h in holdings.items()
+        if h.quantity > 0.001
+    }
+
+
+def _write_checkpoint(db: Session, bv_id: int, as_of: date, holdings: dict, ledger: dict):
+    """Store (or replace) the in-memory positions and open lots as of a month end."""
+    lots = [
+        [ticker, lot["buy_tx_id"], lot["date"].isoformat(), lot["quantity"], lot["cost"], lot["remaining_quantity"]]
+        for ticker, open_lots in ledger["lots"].items()
+        for lot in open_lots
+    ]
+    db.execute(delete(HoldingCheckpoint).where(
+        HoldingCheckpoint.bv_id == bv_id, HoldingCheckpoint.as_of == as_of
+    ))
+    db.add(HoldingCheckpoint(bv_id=bv_id, as_of=as_of, positions=_positions(holdings), lots=lots))
+
+
+def _restore_checkpoint(bv_id: int, checkpoint) -> tuple[dict, dict]:
+    """Detached holdings map and ledger as they were at a checkpoint."""
+    holdings = {}
+    lots = defaultdict(deque)
+    if checkpoint:
+        for ticker, p in checkpoint.positions.items():
+            holdings[ticker] = Holding(bv_id=bv_id, ticker=ticker, **p)
+        for ticker, buy_tx_id, day, quantity, cost, remaining in checkpoint.lots:
+            lots[ticker].append({
+                "id": None,
+                "bv_id": bv_id,
+                "ticker": ticker,
+                "buy_tx_id": buy_tx_id,
+                "date": date.fromisoformat(day),
+                "quantity": quantity,
+                "cost": cost,
+                "remaining_quantity": remaining,
+                "changed": False,
+            })
+    return holdings, {"lots": lots, "new_lots": [], "closed": [], "gains": []}
+
+
 def get_holdings_summary(db: Session, bv_id: int) -> dict:
     """Get current holdings summary for a BV."""
     holdings = db.query(Holding).filter_by(bv_id=bv_id).all()
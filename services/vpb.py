@@ -65,8 +65,9 @@ def generate_vpb_aangifte(db, bv_id: int, year: int) -> dict:
 
     Returns a dict with all fields needed to file via Mijn Belastingdienst Zakelijk.
     """
-    from models import BV, AnnualReport, VPBFiling, Transaction, Holding
-    from sqlalchemy import extract
+    from models import BV, AnnualReport, VPBFiling
+    from services.ledger_cache import get_ledger
+    from services.transaction_engine import holdings_as_of
 
     bv = db.query(BV).get(bv_id)
     report = db.query(AnnualReport).filter_by(bv_id=bv_id, year=year).first()
@@ -83,51 +84,32 @@ def generate_vpb_aangifte(db, bv_id: int, year: int) -> dict:
     boekjaar_start = date(year, 1, 1)
     boekjaar_eind = date(year, 12, 31)
 
-    # Holdings detail for effectenspecificatie
-    holdings = db.query(Holding).filter_by(bv_id=bv_id).all()
+    # Holdings detail for effectenspecificatie, positions at year end
+    positions = holdings_as_of(db, bv_id, boekjaar_eind)
     effecten_detail = []
-    for h in holdings:
-        if h.quantity > 0:
-            effecten_detail.append({
-                "ticker": h.ticker,
-                "naam": h.name,
-                "aantal": h.quantity,
-                "kostprijs_per_stuk": round(h.avg_cost_price, 2),
-                "totale_kostprijs": round(h.total_cost, 2),
-            })
+    for ticker, p in positions.items():
+        effecten_detail.append({
+            "ticker": ticker,
+            "naam": p["name"],
+            "aantal": p["quantity"],
+            "kostprijs_per_stuk": round(p["avg_cost_price"], 2),
+            "totale_kostprijs": round(p["total_cost"], 2),
+        })
 
     # Transaction summary per type for the year
-    year_txs = (
-        db.query(Transaction)
-        .filter(Transaction.bv_id == bv_id, extract("year", Transaction.date) == year)
-        .all()
-    )
-
+    ledger = get_ledger(db, bv_id)
     tx_summary = {
-        "aankopen": 0.0,
-        "verkopen": 0.0,
-        "dividend": 0.0,
-        "rente": 0.0,
-        "kosten": 0.0,
-        "stortingen": 0.0,
-        "onttrekkingen": 0.0,
+        label: ledger.total(tx_type, boekjaar_start, boekjaar_eind)
+        for label, tx_type in (
+            ("aankopen", "buy"),
+            ("verkopen", "sell"),
+            ("dividend", "dividend"),
+            ("rente", "interest"),
+            ("kosten", "cost"),
+            ("stortingen", "deposit"),
+            ("onttrekkingen", "withdrawal"),
+        )
     }
-    for tx in year_txs:
-        if tx.type == "buy":
-            tx_summary["aankopen"] += abs(tx.amount)
-        elif tx.type == "sell":
-            tx_summary["verkopen"] += abs(tx.amount)
-        elif tx.type == "dividend":
-            tx_summary["dividend"] += abs(tx.amount)
-        elif tx.type == "interest":
-            tx_summary["rente"] += abs(tx.amount)
-        elif tx.type == "cost":
-            tx_summary["kosten"] += abs(tx.amount)
-        elif tx.type == "deposit":
-            tx_summary["stortingen"] += abs(tx.amount)
-        elif tx.type == "withdrawal":
-            tx_summary["onttrekkingen"] += abs(tx.amount)
-
     tx_summary = {k: round(v, 2) for k, v in tx_summary.items()}
 
     # Deadline
@@ -0,0 +1,97 @@
+"""Local stand-in for the Anthropic Messages API, for developing the classifier.
+
+Answers classification prompts with the rule-based classifier, optionally with
+artificial latency and failures, so chunking, concurrency and retries can be
+exercised without network access or API costs.
+
+Usage:
+    python stub_anthropic.py [--port 8099] [--delay 0.2] [--fail-rate 0.1]
+    ANTHROPIC_API_KEY=stub ANTHROPIC_BASE_URL=http://localhost:8099 python app.py
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Ensure we can import from project root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from services.ai_classifier import _rule_based_classify
+
+PROMPT_LINE = re.compile(r'^(\d+): desc="(.*)", amount=([^,]*), qty=([^,]*), price=(.*)$', re.M)
+
+
+def _num(val: str):
+    try:
+        return float(val)
+    except ValueError:
+        return None
+
+
+def classify_prompt(prompt: str) -> list[dict]:
+    rows = [
+        {"index": int(i), "description": desc, "amount": _num(amount) or 0, "quantity": _num(qty), "price": _num(price)}
+        for i, desc, amount, qty, price in PROMPT_LINE.findall(prompt)
+    ]
+    _rule_based_classify(rows)
+    return [{"index": row["index"], "type": row["type"]} for row in rows]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    fail_rate = 0.0
+
+    def do_POST(self):
+        if not self.path.endswith("/v1/messages"):
+            return self._send(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            return self._send(529, {"type": "error", "error": {"type": "overloaded_error", "message": "stub overload"}})
+
+        text = json.dumps(classify_prompt(body["messages"][0]["content"]))
+        self._send(200, {
+            "id": f"msg_stub_{time.time_ns()}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "stub"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": 0, "output_tokens": 0},
+        })
+
+    def _send(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Anthropic Messages API")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds of latency per request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with 529")
+    args = parser.parse_args()
+
+    StubHandler.delay = args.delay
+    StubHandler.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StubHandler)
+    print(f"Stub Anthropic API on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""The per-BV reads use the indexes added for them (EXPLAIN QUERY PLAN on SQLite)."""
+
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+from models import BV, Holding, Transaction, User, init_db
+from services.read_models import holding_rows, trade_rows, transaction_rows
+from services.rollups import years
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine, Session = init_db(f"sqlite:///{tmp_path / 'plans.db'}")
+    session = Session()
+    user = User(email="plan@example.com", name="Plan")
+    session.add(user)
+    session.flush()
+    bv = BV(user_id=user.id, name="Plan BV")
+    session.add(bv)
+    session.flush()
+    for day in range(1, 29):
+        session.add(Transaction(bv_id=bv.id, date=date(2024, 1, day), type="buy", ticker="VWRL.AS",
+                                description="VWRL", quantity=1, price=100.0, amount=-100.0, processed=True))
+    session.add(Holding(bv_id=bv.id, ticker="VWRL.AS", name="VWRL", quantity=28, avg_cost_price=100.0,
+                        total_cost=2800.0))
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def query_plans(db, read) -> list[str]:
+    """Run read() and return the query plan of every SELECT it sent, one string per statement."""
+    engine = db.get_bind()
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        read()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    assert statements
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        return [
+            " / ".join(row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters))
+            for statement, parameters in statements
+        ]
+    finally:
+        conn.close()
+
+
+def bv_id(db) -> int:
+    return db.query(BV.id).scalar()
+
+
+def test_transaction_year_filter_uses_date_index(db):
+    plans = query_plans(db, lambda: transaction_rows(db, bv_id(db), year=2024))
+    assert "USING INDEX ix_transactions_bv_date (bv_id=? AND date>? AND date<?)" in plans[-1]
+
+
+def test_trade_rows_use_date_index(db):
+    plans = query_plans(db, lambda: trade_rows(db, bv_id(db), until=date(2024, 12, 31), after=date(2023, 12, 31)))
+    assert "USING INDEX ix_transactions_bv_date (bv_id=? AND date>? AND date<?)" in plans[-1]
+
+
+def test_years_lookup_uses_rollup_index(db):
+    plans = query_plans(db, lambda: years(db, bv_id(db)))
+    assert "ix_transaction_rollups_bv_year_month_type (bv_id=?)" in plans[-1]
+
+
+def test_holdings_list_uses_ticker_index(db):
+    plans = query_plans(db, lambda: holding_rows(db, bv_id(db)))
+    assert "USING INDEX ix_holdings_bv_ticker (bv_id=?)" in plans[-1]
+    assert "TEMP B-TREE" not in plans[-1]